@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Measures the plugin's own overhead with sDNA replaced by a stub.
+
+ Runs extract_args, extract_syntax and processAlgorithm of SDNAAlgorithm under a headless
+ QGIS on synthetic street grids of several sizes, field counts and source formats, and
+ reports wall time and peak memory for each phase. Results can be saved as a JSON baseline
+ and later runs compared against it, failing if any phase has slowed down.
+
+ Run with the Python of a QGIS installation, e.g.
+
+     python benchmarks/bench_plugin.py --sizes 10000,100000 --baseline benchmarks/baseline.json
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import argparse
+import importlib
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from qgis.core import (
+    QgsApplication,
+    QgsCoordinateReferenceSystem,
+    QgsFeature,
+    QgsField,
+    QgsGeometry,
+    QgsPointXY,
+    QgsProcessingContext,
+    QgsProcessingFeedback,
+    QgsProject,
+    QgsVectorFileWriter,
+    QgsVectorLayer
+)
+from PyQt5.QtCore import QVariant
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GRID_SPACING = 100.0
+CRS = "EPSG:27700"
+CHUNK_SIZE = 50000
+
+# Plugin modules, which can only be imported once QGIS is running
+plugin_modules = {}
+
+
+class FakeIntegralSpec:
+    """Minimal stand-in for sDNA's Integral Analysis tool specification."""
+
+    alias = "Benchmark Integral Analysis"
+    category = "Benchmark"
+    desc = "Stub tool used to benchmark the plugin without sDNA"
+
+    def getInputSpec(self):
+        return [
+            ("input", "Input polyline features", "FC", "Polyline", "", True),
+            ("output", "Output features", "OFC", None, "", True),
+            ("weight", "Weight", "Field", ("Numeric", "input"), "", False),
+            ("radii", "Radius list", "Text", None, "n", False),
+            ("metric", "Analysis metric", "Text", ["ANGULAR", "EUCLIDEAN", "CUSTOM"], "ANGULAR", False)
+        ]
+
+    def getSyntax(self, args):
+        return {
+            "command": "sdnaintegral",
+            "inputs": {"net": args["input"]},
+            "outputs": {"net": args["output"]},
+            "config": f'"radii={args["radii"]};metric={args["metric"]};weight={args["weight"]}"'
+        }
+
+
+class FakeRunSDNACommand:
+    """Stand-in for runsdnacommand: copies the input to the output and reports progress like sDNA."""
+
+    def __init__(self, progress_messages):
+        self.progress_messages = progress_messages
+
+    def __call__(self, syntax, sdna_path, progress, pythonexe=None, pythonpath=None):
+        progress.setInfo(f"Running external command: {syntax['command']}")
+        for i in range(self.progress_messages):
+            progress.setInfo(f"Processing link {i}")
+            progress.setPercentage(100 * i // max(1, self.progress_messages))
+        source_root = os.path.splitext(syntax["inputs"]["net"])[0]
+        output_root = os.path.splitext(syntax["outputs"]["net"])[0]
+        for extension in [".shp", ".shx", ".dbf", ".prj", ".cpg"]:
+            if os.path.isfile(source_root + extension):
+                shutil.copyfile(source_root + extension, output_root + extension)
+        return 0
+
+
+def measure(results, phase, function, *args):
+    instrumentation = plugin_modules["instrumentation"]
+    started = time.perf_counter()
+    with instrumentation.PeakMemorySampler(interval=0.01) as sampler:
+        value = function(*args)
+    results[phase] = {
+        "wall_s": round(time.perf_counter() - started, 4),
+        "peak_rss_mb": round(sampler.peak_rss / instrumentation.MB, 1)
+    }
+    return value
+
+
+def make_grid_layer(link_count, field_count):
+    """Return a memory layer holding a square street grid of about link_count links."""
+    layer = QgsVectorLayer(f"LineString?crs={CRS}", "grid", "memory")
+    provider = layer.dataProvider()
+    provider.addAttributes([QgsField(f"f{i}", QVariant.Double) for i in range(field_count)])
+    layer.updateFields()
+
+    side = max(1, math.ceil(math.sqrt(link_count / 2)))
+    features = []
+    link = 0
+    for row in range(side + 1):
+        for column in range(side + 1):
+            for dx, dy in [(1, 0), (0, 1)]:
+                if link >= link_count or column + dx > side or row + dy > side:
+                    continue
+                start = QgsPointXY(column * GRID_SPACING, row * GRID_SPACING)
+                end = QgsPointXY((column + dx) * GRID_SPACING, (row + dy) * GRID_SPACING)
+                feature = QgsFeature(layer.fields())
+                feature.setGeometry(QgsGeometry.fromPolylineXY([start, end]))
+                feature.setAttributes([float((link * (i + 1)) % 997) for i in range(field_count)])
+                features.append(feature)
+                link += 1
+                if len(features) >= CHUNK_SIZE:
+                    provider.addFeatures(features)
+                    features = []
+    provider.addFeatures(features)
+    layer.updateExtents()
+    return layer
+
+
+def make_source(memory_layer, source_kind, folder):
+    """Return the layer to benchmark in the requested source format."""
+    if source_kind == "memory":
+        return memory_layer
+    driver, extension = {"gpkg": ("GPKG", "gpkg"), "shp": ("ESRI Shapefile", "shp")}[source_kind]
+    path = os.path.join(folder, f"grid.{extension}")
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = driver
+    QgsVectorFileWriter.writeAsVectorFormatV2(memory_layer, path, QgsProject.instance().transformContext(), options)
+    return QgsVectorLayer(path, "grid", "ogr")
+
+
+def run_scenario(algorithm_module, link_count, field_count, source_kind, progress_messages):
+    results = {}
+    folder = tempfile.mkdtemp(prefix="sdna_bench_")
+    scratch = None
+    try:
+        memory_layer = measure(results, "generate", make_grid_layer, link_count, field_count)
+        layer = make_source(memory_layer, source_kind, folder)
+        context = QgsProcessingContext()
+        context.setProject(QgsProject.instance())
+        context.temporaryLayerStore().addMapLayer(layer)
+        feedback = QgsProcessingFeedback()
+
+        algorithm = algorithm_module.SDNAAlgorithm(
+            FakeIntegralSpec(), '"benchmark"', FakeRunSDNACommand(progress_messages)
+        )
+        # extract_syntax converts into the algorithm's first scratch space, which processAlgorithm
+        # replaces with its own, so it is kept to be cleaned up here
+        scratch = algorithm.scratch
+        algorithm.initAlgorithm({})
+        parameters = {
+            "input": layer.id(),
+            "output": os.path.join(folder, "output.shp"),
+            "weight": "f0" if field_count else None,
+            "radii": "n",
+            "metric": 0
+        }
+
+        args = measure(results, "extract_args", algorithm.extract_args, parameters, context)
+        crs = QgsCoordinateReferenceSystem(CRS)
+        measure(results, "extract_syntax", algorithm.extract_syntax, args, context, feedback, crs)
+        measure(results, "processAlgorithm", algorithm.processAlgorithm, parameters, context, feedback)
+    finally:
+        if scratch is not None:
+            scratch.cleanup()
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return a description of each phase that is slower than its baseline by more than tolerance."""
+    regressions = []
+    for scenario, phases in results.items():
+        for phase, measured in phases.items():
+            expected = baseline.get(scenario, {}).get(phase)
+            if expected and measured["wall_s"] > expected["wall_s"] * (1 + tolerance):
+                regressions.append(
+                    f"{scenario} {phase}: {measured['wall_s']:.3f}s against baseline {expected['wall_s']:.3f}s"
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma separated link counts, up to 5000000")
+    parser.add_argument("--fields", default="2,20,80", help="comma separated attribute field counts")
+    parser.add_argument("--sources", default="memory,gpkg,shp", help="comma separated source formats")
+    parser.add_argument("--progress-messages", type=int, default=10000,
+                        help="number of progress messages the stub sDNA reports per run")
+    parser.add_argument("--baseline", help="JSON file of baseline results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fractional slowdown allowed before a phase counts as a regression")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    options = parser.parse_args(argv)
+
+    QgsApplication.setPrefixPath(os.environ.get("QGIS_PREFIX_PATH", sys.prefix), True)
+    # A profile of its own keeps the benchmark's settings, and the stub runs it records for
+    # calibrating cost estimates, out of the user's QGIS profile
+    profile_folder = tempfile.mkdtemp(prefix="sdna_bench_profile_")
+    application = QgsApplication([], False, profile_folder)
+    application.initQgis()
+    sys.path.append(os.path.join(QgsApplication.pkgDataPath(), "python", "plugins"))
+    from processing.core.Processing import Processing
+    Processing.initialize()
+
+    sys.path.insert(0, os.path.dirname(PLUGIN_DIR))
+    algorithm_module = importlib.import_module(f"{os.path.basename(PLUGIN_DIR)}.sdna_plugin_algorithm")
+    plugin_modules["instrumentation"] = importlib.import_module(f"{os.path.basename(PLUGIN_DIR)}.sdna_plugin_instrumentation")
+
+    results = {}
+    for link_count in [int(size) for size in options.sizes.split(",")]:
+        for field_count in [int(fields) for fields in options.fields.split(",")]:
+            for source_kind in options.sources.split(","):
+                scenario = f"{source_kind}_{link_count}_links_{field_count}_fields"
+                print(f"Running {scenario}", flush=True)
+                results[scenario] = run_scenario(
+                    algorithm_module, link_count, field_count, source_kind, options.progress_messages
+                )
+                for phase, measured in results[scenario].items():
+                    print(f"    {phase:<18} {measured['wall_s']:>9.3f}s {measured['peak_rss_mb']:>9.1f} MB", flush=True)
+
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    status = 0
+    if options.baseline and options.save_baseline:
+        with open(options.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"Saved baseline to {options.baseline}")
+    elif options.baseline:
+        with open(options.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), options.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        status = 1 if regressions else 0
+
+    application.exitQgis()
+    shutil.rmtree(profile_folder, ignore_errors=True)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
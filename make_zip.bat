@@ -1,7 +1,23 @@
 rmdir sdna
 mkdir sdna
 copy metadata.txt sdna\
+copy sdna_batch.py sdna\
 copy sdna_plugin.py sdna\
 copy sdna_plugin_algorithm.py sdna\
+copy sdna_plugin_cache.py sdna\
+copy sdna_plugin_costmodel.py sdna\
+copy sdna_plugin_formats.py sdna\
+copy sdna_plugin_incremental.py sdna\
+copy sdna_plugin_instrumentation.py sdna\
+copy sdna_plugin_jobs.py sdna\
+copy sdna_plugin_matrix.py sdna\
+copy sdna_plugin_process.py sdna\
 copy sdna_plugin_provider.py sdna\
+copy sdna_plugin_scratch.py sdna\
+copy sdna_plugin_specs.py sdna\
+copy sdna_plugin_sweep.py sdna\
+copy sdna_plugin_tiling.py sdna\
+copy sdna_plugin_worker.py sdna\
+copy sdna_plugin_writeback.py sdna\
+copy sdna_worker.py sdna\
 7z a -tzip sdna.zip sdna
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Runs a batch of sDNA algorithms without the QGIS desktop.
+
+ Each worker process starts a headless QGIS, registers the sDNA provider and runs jobs from
+ the job file, a JSON file such as
+
+     {
+         "settings": {"SDNA_FOLDER_SETTING": "/opt/sdna"},
+         "jobs": [
+             {"id": "option_a", "algorithm": "sDNA Provider:Integral Analysis",
+              "parameters": {"input": "/data/option_a.shp", "output": "/results/option_a.shp", "radii": "800"}}
+         ]
+     }
+
+ where settings are sDNA provider settings, and algorithm ids and parameters are as for
+ processing.run. An algorithm id is the provider id, "sDNA Provider", a colon and the
+ alias of the sDNA tool, with "_sweep" appended for its parameter sweep. A summary of
+ each job's status, timing and outputs is written as JSON after every job. Running the
+ same job file again skips jobs the summary shows finished with their outputs in place,
+ so a batch can be resumed after a failure.
+
+ Run with the Python of a QGIS installation, e.g.
+
+     python sdna_batch.py jobs.json --processes 8 --summary jobs.summary.json
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    as_completed
+)
+
+from qgis.core import (
+    QgsApplication,
+    QgsProcessingContext,
+    QgsProcessingFeedback,
+    QgsProject
+)
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Things that must outlive init_worker in each worker process
+worker_state = {}
+
+
+class PrintingFeedback(QgsProcessingFeedback):
+    """Prints a job's progress messages and errors, prefixed with the job's id."""
+
+    def __init__(self, job_id):
+        QgsProcessingFeedback.__init__(self)
+        self.job_id = job_id
+
+    def setProgressText(self, text):
+        print(f"[{self.job_id}] {text}", flush=True)
+
+    def pushInfo(self, info):
+        print(f"[{self.job_id}] {info}", flush=True)
+
+    def reportError(self, error, fatalError=False):
+        print(f"[{self.job_id}] ERROR: {error}", file=sys.stderr, flush=True)
+
+
+def timestamp():
+    return time.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def load_jobs(path):
+    """Return the provider settings and the list of jobs in the job file at path."""
+    with open(path, encoding="utf-8") as job_file:
+        description = json.load(job_file)
+    if isinstance(description, list):
+        description = {"jobs": description}
+    jobs = []
+    for index, job in enumerate(description.get("jobs", [])):
+        if "algorithm" not in job:
+            raise ValueError(f"Job {index + 1} of {path} has no algorithm")
+        jobs.append({
+            "id": str(job.get("id", f"job_{index + 1}")),
+            "algorithm": job["algorithm"],
+            "parameters": job.get("parameters", {})
+        })
+    ids = [job["id"] for job in jobs]
+    duplicates = sorted(set(job_id for job_id in ids if ids.count(job_id) > 1))
+    if duplicates:
+        raise ValueError(f"Job ids are not unique: {', '.join(duplicates)}")
+    return description.get("settings", {}), jobs
+
+
+def load_summary(path, job_file):
+    try:
+        with open(path, encoding="utf-8") as summary_file:
+            summary = json.load(summary_file)
+    except (OSError, ValueError):
+        summary = {}
+    summary["job_file"] = os.path.abspath(job_file)
+    summary.setdefault("jobs", {})
+    return summary
+
+
+def write_summary(path, summary):
+    # Written in full and then moved into place, so an interrupted batch never leaves half a summary
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    os.replace(temporary_path, path)
+
+
+def output_value(value):
+    """Return an algorithm result as it is recorded in the summary: paths as they are, anything else as text."""
+    if isinstance(value, (list, tuple)):
+        return [output_value(item) for item in value]
+    return value if isinstance(value, (str, int, float, bool)) or value is None else str(value)
+
+
+def is_done(record):
+    """Whether a job's summary record shows it finished, with every output file still in place."""
+    if not record or record.get("status") != "finished":
+        return False
+    for value in record.get("outputs", {}).values():
+        for path in value if isinstance(value, list) else [value]:
+            if isinstance(path, str) and os.path.isabs(path) and os.path.splitext(path)[1] and not os.path.exists(path):
+                return False
+    return True
+
+
+def print_log_message(message, tag, level):
+    print(f"[{tag}] {message}", file=sys.stderr, flush=True)
+
+
+def init_worker(plugin_dir, settings):
+    """Start a headless QGIS in this worker process and register the sDNA provider."""
+    QgsApplication.setPrefixPath(os.environ.get("QGIS_PREFIX_PATH", sys.prefix), True)
+    application = QgsApplication([], False)
+    application.initQgis()
+    worker_state["application"] = application
+    QgsApplication.messageLog().messageReceived.connect(print_log_message)
+
+    sys.path.append(os.path.join(QgsApplication.pkgDataPath(), "python", "plugins"))
+    from processing.core.Processing import Processing
+    from processing.core.ProcessingConfig import ProcessingConfig
+    Processing.initialize()
+
+    sys.path.insert(0, os.path.dirname(plugin_dir))
+    provider_module = importlib.import_module(f"{os.path.basename(plugin_dir)}.sdna_plugin_provider")
+    provider = provider_module.SDNAPluginProvider()
+    # Settings must be in place before the provider is added, which loads sDNA's tools
+    for name, value in settings.items():
+        ProcessingConfig.setSettingValue(name, value)
+    QgsApplication.processingRegistry().addProvider(provider)
+    worker_state["provider"] = provider
+
+
+def run_job(job):
+    """Run one job in a worker process and return its id and summary record."""
+    import processing
+    record = {"algorithm": job["algorithm"], "started": timestamp(), "pid": os.getpid()}
+    context = QgsProcessingContext()
+    context.setProject(QgsProject.instance())
+    feedback = PrintingFeedback(job["id"])
+    started = time.perf_counter()
+    try:
+        results = processing.run(job["algorithm"], job["parameters"], context=context, feedback=feedback)
+        record["status"] = "finished"
+        record["outputs"] = {name: output_value(value) for name, value in results.items()}
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = str(e)
+    record["wall_s"] = round(time.perf_counter() - started, 3)
+    return job["id"], record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("job_file", help="JSON file listing the jobs to run")
+    parser.add_argument("--processes", type=int, default=1, help="number of jobs to run at once")
+    parser.add_argument("--summary", help="JSON summary to write and resume from (default: next to the job file)")
+    parser.add_argument("--sdna-folder", help="sDNA installation folder, overriding the job file's settings")
+    parser.add_argument("--rerun", action="store_true", help="run every job, even those already finished")
+    options = parser.parse_args(argv)
+
+    settings, jobs = load_jobs(options.job_file)
+    if options.sdna_folder:
+        settings["SDNA_FOLDER_SETTING"] = options.sdna_folder
+    summary_path = options.summary or f"{os.path.splitext(options.job_file)[0]}.summary.json"
+    summary = load_summary(summary_path, options.job_file)
+    pending = [job for job in jobs if options.rerun or not is_done(summary["jobs"].get(job["id"]))]
+    print(f"{len(pending)} of {len(jobs)} jobs to run with {options.processes} processes", flush=True)
+    summary["started"] = timestamp()
+    summary.pop("finished", None)
+    write_summary(summary_path, summary)
+
+    # QGIS cannot be forked once initialised, so each worker starts afresh
+    executor = ProcessPoolExecutor(
+        max_workers=max(1, options.processes),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(PLUGIN_DIR, settings)
+    )
+    with executor:
+        futures = {executor.submit(run_job, job): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                job_id, record = future.result()
+            except Exception as e:
+                # The worker process died, taking the job with it
+                job_id, record = job["id"], {"algorithm": job["algorithm"], "status": "failed", "error": f"Worker failed: {e}"}
+            summary["jobs"][job_id] = record
+            write_summary(summary_path, summary)
+            print(f"{job_id} {record['status']} after {record.get('wall_s', 0):.1f}s", flush=True)
+
+    summary["finished"] = timestamp()
+    write_summary(summary_path, summary)
+    failed = [job["id"] for job in jobs if not is_done(summary["jobs"].get(job["id"]))]
+    if failed:
+        print(f"{len(failed)} jobs did not finish: {', '.join(failed)}", flush=True)
+    print(f"Summary written to {summary_path}", flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
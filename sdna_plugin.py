@@ -22,8 +22,12 @@ __revision__ = "$Format:%H$"
 import inspect
 import os
 import sys
+import time
 
-from qgis.core import QgsApplication
+from qgis.core import (
+    QgsApplication,
+    QgsMessageLog
+)
 
 from .sdna_plugin_provider import SDNAPluginProvider
 
@@ -40,8 +44,10 @@ class SDNAPlugin(object):
 
     def initProcessing(self):
         """Init Processing provider for QGIS >= 3.8."""
+        started = time.perf_counter()
         self.provider = SDNAPluginProvider()
         QgsApplication.processingRegistry().addProvider(self.provider)
+        QgsMessageLog.logMessage(f"sDNA plugin startup took {(time.perf_counter() - started) * 1000:.0f} ms", "sDNA")
 
     def initGui(self):
         self.initProcessing()
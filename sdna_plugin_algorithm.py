@@ -19,9 +19,15 @@ __copyright__ = "(C) 2020 Cardiff University"
 
 __revision__ = "$Format:%H$"
 
+import collections
+import functools
+import json
 import os
+import shutil
 import sys
-import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from PyQt5.QtCore import QVariant
 from qgis.PyQt.QtCore import QCoreApplication
@@ -34,6 +40,9 @@ from qgis.core import (
     QgsProcessingOutputVectorLayer,
     QgsProcessingParameterBoolean,
     QgsProcessingParameterEnum,
+    QgsProcessingParameterExtent,
+    QgsProcessingParameterNumber,
+    QgsProcessingException,
     QgsProcessingParameterField,
     QgsProcessingParameterFile,
     QgsProcessingParameterString,
@@ -42,11 +51,76 @@ from qgis.core import (
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterFileDestination,
     QgsProcessingParameterVectorDestination,
+    QgsProcessingParameterDefinition,
+    QgsProcessingFeatureSourceDefinition,
+    QgsProcessingOutputLayerDefinition,
+    QgsCoordinateTransform,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsFeedback,
+    QgsField,
+    QgsFields,
     QgsVectorLayer,
     QgsVectorFileWriter,
     QgsProcessingUtils
 )
 import qgis.utils
+from processing.core.ProcessingConfig import ProcessingConfig
+
+from .sdna_plugin_cache import (
+    ConversionCache,
+    RunCache,
+    shapefile_parts
+)
+from .sdna_plugin_formats import (
+    OUTPUT_FORMATS,
+    transcode
+)
+from .sdna_plugin_incremental import (
+    FULL_RUN_FRACTION,
+    IncrementalStore,
+    affected_features,
+    diff_fingerprints,
+    layer_fingerprints,
+    merge_outputs
+)
+from .sdna_plugin_costmodel import (
+    CostModel,
+    cost_features,
+    format_duration
+)
+from .sdna_plugin_instrumentation import RunRecorder
+from .sdna_plugin_matrix import convert_csv_to_matrix
+from .sdna_plugin_process import (
+    ResourceLimits,
+    SDNAProcessWatchdog,
+    run_marker,
+    run_processes
+)
+from .sdna_plugin_scratch import (
+    SDNA_OUTPUT_FIELDS,
+    ScratchSpace,
+    estimate_shapefile_size
+)
+from .sdna_plugin_tiling import (
+    AREA_OF_INTEREST_FIELD,
+    WRITE_CHUNK_SIZE,
+    TileGrid,
+    area_geometry,
+    features_in_area,
+    features_near_area,
+    mark_links_in_area,
+    max_link_length,
+    max_radius,
+    stitch_outputs
+)
+from .sdna_plugin_writeback import (
+    RESULT_FIELDS_PROPERTY,
+    SOURCE_ID_FIELD,
+    open_for_writing,
+    same_data,
+    write_back
+)
 
 
 class ShapefileParameterVectorDestination(QgsProcessingParameterVectorDestination):
@@ -68,17 +142,107 @@ class ShapefileParameterVectorDestination(QgsProcessingParameterVectorDestinatio
         return "shp"
 
 
+@functools.lru_cache(maxsize=None)
+def qgis_python_installation():
+    """Return the Python interpreter and path sDNA should run with, which never change during a session."""
+    qgisbase = os.path.dirname(os.path.dirname(sys.executable))
+    pythonexe = os.path.join(qgisbase, "bin", "python3.exe")
+    pythonbase = os.path.join(qgisbase, "apps", "python27")
+    pythonpath = ";".join([os.path.join(pythonbase, x) for x in ["", "Lib", "Lib/site-packages"]])
+    return pythonexe, pythonpath
+
+
+class InputExportOptions:
+    """How an input layer is filtered when it is written out for sDNA."""
+
+    def __init__(self, selected_only=False, extent=None, field_names=None, id_field=None, feature_ids=None, excluded_fields=None):
+        self.selected_only = selected_only
+        self.extent = extent
+        # None exports every field, a list exports only those fields
+        self.field_names = field_names
+        # If set, each feature's id is exported in a field of this name
+        self.id_field = id_field
+        # None exports every feature, a collection of ids exports only those features
+        self.feature_ids = feature_ids
+        # Fields never exported, such as results written back onto the layer by an earlier run
+        self.excluded_fields = excluded_fields or []
+
+    def is_filtered(self):
+        return (
+            self.selected_only or self.extent is not None or self.field_names is not None
+            or self.id_field is not None or self.feature_ids is not None or bool(self.excluded_fields)
+        )
+
+    def exported_field_indexes(self, layer):
+        """Return the indexes of the fields of layer that are exported, leaving out the id field."""
+        lower_names = [name.lower() for name in layer.fields().names()]
+        if self.field_names is None:
+            indexes = range(len(lower_names))
+        else:
+            indexes = sorted(set(
+                lower_names.index(name.lower()) for name in self.field_names if name.lower() in lower_names
+            ))
+        excluded = {name.lower() for name in self.excluded_fields}
+        return [index for index in indexes if lower_names[index] not in excluded]
+
+    def exported_feature_ids(self, layer):
+        """Return the ids of the features of layer that are exported, or None for every feature in the extent."""
+        feature_ids = set(layer.selectedFeatureIds()) if self.selected_only else None
+        if self.feature_ids is not None:
+            feature_ids = set(self.feature_ids) if feature_ids is None else feature_ids.intersection(self.feature_ids)
+        return feature_ids
+
+    def feature_request(self, layer):
+        """Return a request for the features of layer that are exported."""
+        request = QgsFeatureRequest()
+        if self.extent is not None:
+            request.setFilterRect(self.extent)
+        feature_ids = self.exported_feature_ids(layer)
+        if feature_ids is not None:
+            request.setFilterFids(sorted(feature_ids))
+        return request
+
+
 class SDNAAlgorithm(QgsProcessingAlgorithm):
 
+    EXTENT = "EXTENT"
+    PRUNE_FIELDS = "PRUNE_FIELDS"
+    FORCE_RECOMPUTE = "FORCE_RECOMPUTE"
+    TILES = "TILES"
+    MAX_PROCESSES = "MAX_PROCESSES"
+    QUEUE = "QUEUE"
+    PRIORITY = "PRIORITY"
+    WRITE_BACK_LAYER = "WRITE_BACK_LAYER"
+    WRITE_BACK_KEY = "WRITE_BACK_KEY"
+    CONVERT_MATRICES = "CONVERT_MATRICES"
+    INCREMENTAL_BASE = "INCREMENTAL_BASE"
+    RECORD_INCREMENTAL = "RECORD_INCREMENTAL"
+    AREA_OF_INTEREST = "AREA_OF_INTEREST"
+    OUTPUT_FORMAT = "OUTPUT_FORMAT"
+
     def __init__(self, algorithm_spec, sdna_path, run_sdna_command):
         QgsProcessingAlgorithm.__init__(self)
         self.outputs = []
         self.varnames = []
         self.outputnames = []
+        self.layeroutputnames = []
+        self.layervarnames = []
+        self.fieldvarsources = {}
         self.selectvaroptions = {}
         self.sdna_path = sdna_path
         self.run_sdna_command = run_sdna_command
         self.algorithm_spec = algorithm_spec
+        self.recorder = RunRecorder(algorithm_spec.alias)
+        self.scratch = ScratchSpace()
+        self.write_back_target = None
+        self.written_result_fields = None
+        self.matrix_outputs = {}
+        self.input_fingerprints = None
+        self.area_link_ids = None
+        self.cost = None
+        self.sdna_retval = None
+        self.limits = ResourceLimits()
+        self.written_outputs = []
 
     def initAlgorithm(self, config):
         """Set up the algorithm, add the parameters, etc."""
@@ -100,6 +264,7 @@ class SDNAAlgorithm(QgsProcessingAlgorithm):
                 self.varnames += [varname]
 
             if datatype == "FC":
+                self.layervarnames += [varname]
                 self.addParameter(
                     QgsProcessingParameterFeatureSource(
                         varname,
@@ -109,6 +274,7 @@ class SDNAAlgorithm(QgsProcessingAlgorithm):
                     )
                 )
             elif datatype == "OFC":
+                self.layeroutputnames += [varname]
                 output = ShapefileParameterVectorDestination(
                     varname,
                     self.tr(displayname)
@@ -143,8 +309,16 @@ class SDNAAlgorithm(QgsProcessingAlgorithm):
                 )
                 self.outputs.append(output)
                 self.addParameter(output)
+                if self.supports_plugin_parameter(SDNAAlgorithm.CONVERT_MATRICES):
+                    self.addOutput(
+                        QgsProcessingOutputFile(
+                            self.matrix_output_name(varname),
+                            self.tr(f"{displayname} (binary matrix index)")
+                        )
+                    )
             elif datatype == "Field":
                 fieldtype, source = filter
+                self.fieldvarsources[varname] = source
                 self.addParameter(
                     QgsProcessingParameterField(
                         varname,
@@ -155,6 +329,7 @@ class SDNAAlgorithm(QgsProcessingAlgorithm):
                     )
                 )
             elif datatype == "MultiField":
+                self.fieldvarsources[varname] = filter[1] if isinstance(filter, (list, tuple)) and len(filter) == 2 else "input"
                 self.addParameter(
                     QgsProcessingParameterString(
                         varname,
@@ -198,31 +373,371 @@ class SDNAAlgorithm(QgsProcessingAlgorithm):
             else:
                 raise Exception(f"Unrecognized parameter type: '{datatype}'")
 
+        self.add_plugin_parameters()
+
+    def add_plugin_parameters(self):
+        """Add the plugin's own parameters controlling how inputs are exported and sDNA is run."""
+        extent = QgsProcessingParameterExtent(
+            SDNAAlgorithm.EXTENT,
+            self.tr("Only analyse features intersecting extent"),
+            optional=True
+        )
+        prune_fields = QgsProcessingParameterBoolean(
+            SDNAAlgorithm.PRUNE_FIELDS,
+            self.tr("Only export fields named in the field parameters (do not use with formulas that refer to other fields)"),
+            defaultValue=False,
+            optional=True
+        )
+        force_recompute = QgsProcessingParameterBoolean(
+            SDNAAlgorithm.FORCE_RECOMPUTE,
+            self.tr("Force recompute (ignore results of identical earlier runs)"),
+            defaultValue=False,
+            optional=True
+        )
+        tiles = QgsProcessingParameterNumber(
+            SDNAAlgorithm.TILES,
+            self.tr("Split input into this many tiles along each side and run them separately (needs finite radii)"),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1,
+            optional=True
+        )
+        max_processes = QgsProcessingParameterNumber(
+            SDNAAlgorithm.MAX_PROCESSES,
+            self.tr("Maximum number of concurrent sDNA processes"),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=os.cpu_count() or 1,
+            minValue=1,
+            optional=True
+        )
+        queue = QgsProcessingParameterBoolean(
+            SDNAAlgorithm.QUEUE,
+            self.tr("Queue as a background job (outputs are added to the project when it finishes)"),
+            defaultValue=False,
+            optional=True
+        )
+        priority = QgsProcessingParameterNumber(
+            SDNAAlgorithm.PRIORITY,
+            self.tr("Background job priority (higher runs first)"),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=0,
+            optional=True
+        )
+        write_back_layer = QgsProcessingParameterVectorLayer(
+            SDNAAlgorithm.WRITE_BACK_LAYER,
+            self.tr("Also write results onto this layer or table (e.g. the input layer)"),
+            optional=True
+        )
+        write_back_key = QgsProcessingParameterField(
+            SDNAAlgorithm.WRITE_BACK_KEY,
+            self.tr("Field of the input matching the layer results are written onto (default: feature ID of the input itself)"),
+            parentLayerParameterName="input",
+            optional=True
+        )
+        convert_matrices = QgsProcessingParameterBoolean(
+            SDNAAlgorithm.CONVERT_MATRICES,
+            self.tr("Convert table outputs to memory-mappable binary matrices"),
+            defaultValue=False,
+            optional=True
+        )
+        incremental_base = QgsProcessingParameterFile(
+            SDNAAlgorithm.INCREMENTAL_BASE,
+            self.tr("Earlier output of this tool to update, rerunning only links affected by edits since"),
+            behavior=QgsProcessingParameterFile.File,
+            fileFilter="sDNA outputs (*.shp *.gpkg *.fgb)",
+            optional=True
+        )
+        record_incremental = QgsProcessingParameterBoolean(
+            SDNAAlgorithm.RECORD_INCREMENTAL,
+            self.tr("Record the input so this output can be updated incrementally later (exports a feature ID field with the input)"),
+            defaultValue=False,
+            optional=True
+        )
+        area_of_interest = QgsProcessingParameterFeatureSource(
+            SDNAAlgorithm.AREA_OF_INTEREST,
+            self.tr("Only compute results for links in this area, plus the network needed to keep them exact (needs finite radii)"),
+            types=[QgsProcessing.TypeVectorPolygon],
+            optional=True
+        )
+        output_format = QgsProcessingParameterEnum(
+            SDNAAlgorithm.OUTPUT_FORMAT,
+            self.tr("Format of line outputs (sDNA writes a shapefile, which is then converted)"),
+            options=[name for name, _, _ in OUTPUT_FORMATS],
+            defaultValue=0,
+            optional=True
+        )
+        parameters = [
+            extent, prune_fields, force_recompute, tiles, max_processes, queue, priority, write_back_layer, write_back_key,
+            convert_matrices, incremental_base, record_incremental, area_of_interest, output_format
+        ]
+        for parameter in parameters:
+            if not self.supports_plugin_parameter(parameter.name()):
+                continue
+            parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+            self.addParameter(parameter)
+
+    def supports_plugin_parameter(self, name):
+        """Whether this algorithm honours the plugin parameter called name; those it does not are left out."""
+        return True
 
     def processAlgorithm(self, parameters, context, feedback):
+        if self.parameterAsBool(parameters, SDNAAlgorithm.QUEUE, context):
+            return self.queue_job(parameters, context, feedback)
+
+        self.recorder = RunRecorder(self.name())
+        self.scratch = ScratchSpace.from_settings()
+        self.limits = ResourceLimits.from_settings()
+        self.matrix_outputs = {}
+        self.written_outputs = []
+        self.output_paths = {}
+        self.sdna_retval = None
+        started = time.time()
+        retval = None
+        try:
+            retval = self.process_recorded(parameters, context, feedback)
+        finally:
+            # Outputs are only partial if sDNA itself did not finish; a later step failing
+            # leaves sDNA's complete results in place
+            if self.sdna_retval != 0 or self.limits.exceeded:
+                self.remove_partial_outputs(started)
+            self.scratch.cleanup()
+            self.recorder.finish(retval)
+        if self.limits.exceeded:
+            raise QgsProcessingException(f"sDNA was stopped because the run {self.limits.exceeded}")
+        if feedback.isCanceled():
+            raise QgsProcessingException("sDNA was cancelled")
+        if retval != 0:
+            # Raised so that processing.run, batch runs and the job queue see the run failed
+            raise QgsProcessingException(f"sDNA did not complete successfully (return value {retval})")
+
+        # Return the results of the algorithm: the path each output was written to
+        return_object = dict(self.output_paths)
+        return_object["OUTPUT"] = self.output_paths.get(self.outputs[0].name())
+        return_object.update(self.matrix_outputs)
+        return return_object
+
+    def remove_partial_outputs(self, started):
+        """Delete output files written since started by a run that failed, was cancelled or was stopped.
+
+        Files older than the run are left alone, so a run refused before sDNA starts does not
+        delete the results of an earlier one.
+        """
+        for path in self.written_outputs:
+            for part in shapefile_parts(path):
+                try:
+                    if os.path.getmtime(part) >= started:
+                        os.remove(part)
+                except OSError:
+                    QgsMessageLog.logMessage(f"Could not delete partial output {part}", "sDNA")
+
+    def queue_job(self, parameters, context, feedback):
+        """Hand the run to the provider's background job queue instead of running it now."""
+        job_queue = getattr(self.provider(), "job_queue", None)
+        if job_queue is None:
+            raise QgsProcessingException("The sDNA background job queue is not available")
+        job_parameters = dict(parameters)
+        job_parameters[SDNAAlgorithm.QUEUE] = False
+        extension = OUTPUT_FORMATS[self.parameterAsEnum(parameters, SDNAAlgorithm.OUTPUT_FORMAT, context)][2]
+        outputs = []
+        for outname in self.outputnames:
+            if parameters.get(outname):
+                # Fix output paths now, so the job writes where we say rather than a path of its own choosing
+                job_parameters[outname] = self.parameterAsOutputLayer(parameters, outname, context)
+                if outname in self.layeroutputnames:
+                    outputs.append(self.formatted_output_path(job_parameters[outname], extension))
+                else:
+                    outputs.append(job_parameters[outname])
+        # The outputs do not exist yet; the queue adds them to the project once the job is done
+        context.setLayersToLoadOnCompletion({})
+        job_id = job_queue.submit(
+            self.id(),
+            job_parameters,
+            self.parameterAsInt(parameters, SDNAAlgorithm.PRIORITY, context),
+            self.displayName(),
+            outputs
+        )
+        feedback.setProgressText(f"Queued as background job {job_id}")
+        return {"OUTPUT": self.outputs[0]}
+
+    def process_recorded(self, parameters, context, feedback):
+        """Run the algorithm, recording each phase with self.recorder, and return sDNA's return value."""
         # 'input' is the name of the sDNA variable for the input layer
         source = self.parameterAsSource(parameters, 'input', context)
         source_crs = source.sourceCrs()
 
-        feedback.setProgressText("**********************************************************************\n"\
-                                 "WARNING: sDNA ignores your selection and will process the entire layer\n"\
-                                 "**********************************************************************")
+        input_feature_counts = {}
+        for vn in self.layervarnames:
+            if parameters.get(vn):
+                layer_source = self.parameterAsSource(parameters, vn, context)
+                input_feature_counts[vn] = layer_source.featureCount() if layer_source else None
+        self.recorder.add(input_feature_counts=input_feature_counts)
+        with self.recorder.phase("extract arguments"):
+            args = self.extract_args(parameters, context)
+            export_options = self.extract_export_options(parameters, context, args, source_crs)
+            self.place_temporary_outputs(parameters, context, args, input_feature_counts.get("input"))
+        self.written_outputs = [args[outname] for outname in self.outputnames if args.get(outname)]
+        self.area_link_ids = None
+        area = self.apply_area_of_interest(parameters, context, feedback, args, export_options)
+        if not export_options["input"].selected_only:
+            feedback.setProgressText("**********************************************************************\n"\
+                                     "WARNING: sDNA ignores your selection and will process the entire layer\n"\
+                                     "unless 'Selected features only' is ticked for the input              \n"\
+                                     "**********************************************************************")
+
+        tiles = self.parameterAsInt(parameters, SDNAAlgorithm.TILES, context)
+        max_processes = self.parameterAsInt(parameters, SDNAAlgorithm.MAX_PROCESSES, context) or 1
+        incremental_base = self.parameterAsFile(parameters, SDNAAlgorithm.INCREMENTAL_BASE, context)
+        self.input_fingerprints = None
+        self.cost = None
+        retval = None
+        if incremental_base:
+            self.recorder.add(incremental_base=incremental_base, args=args)
+            retval = self.process_incremental(incremental_base, args, export_options, context, feedback, source_crs)
+        if retval is None:
+            self.check_cost(args, export_options, tiles, max_processes, context, feedback)
+        if retval is None and tiles > 1:
+            self.recorder.add(tiles=tiles, args=args)
+            retval = self.process_tiled(args, export_options, tiles, max_processes, context, feedback, source_crs)
+        elif retval is None:
+            force_recompute = self.parameterAsBool(parameters, SDNAAlgorithm.FORCE_RECOMPUTE, context)
+            retval = self.process_whole(args, export_options, force_recompute, context, feedback, source_crs)
+        self.sdna_retval = retval
+        if retval != 0:
+            QgsMessageLog.logMessage("ERROR: PROCESS DID NOT COMPLETE SUCCESSFULLY", "SDNA")
+            return retval
+        self.report_cost()
+
+        if area is not None:
+            with self.recorder.phase("mark area of interest"):
+                for outname in self.layeroutputnames:
+                    if args.get(outname):
+                        inside = mark_links_in_area(args[outname], area, feedback)
+                        feedback.setProgressText(f"{inside} links of {args[outname]} are in the area of interest")
+        self.write_back_results(parameters, context, args, export_options, feedback)
+        self.transcode_outputs(parameters, context, args, feedback)
+        self.output_paths = {outname: args[outname] for outname in self.outputnames if args.get(outname)}
+        if self.records_increment(parameters, context):
+            self.record_increment(args, export_options, context, feedback, source_crs)
+        if self.parameterAsBool(parameters, SDNAAlgorithm.CONVERT_MATRICES, context):
+            with self.recorder.phase("convert matrices"):
+                self.convert_matrix_outputs(args, feedback)
+        return retval
+
+    def apply_area_of_interest(self, parameters, context, feedback, args, export_options):
+        """Limit the input to the area of interest and the network around it that routes can reach.
+
+        Links within the largest radius plus the longest link of the area are kept, as for a
+        tile, so results for links in the area are exact. The ids of the links in the area
+        are kept in self.area_link_ids. Returns the area in the input's CRS, or None if no
+        area of interest is given.
+        """
+        if not parameters.get(SDNAAlgorithm.AREA_OF_INTEREST):
+            return None
+        area_source = self.parameterAsSource(parameters, SDNAAlgorithm.AREA_OF_INTEREST, context)
+        radius = max_radius(args.get("radii", ""))
+        if radius is None:
+            raise QgsProcessingException("An area of interest needs finite radii")
+        layer = QgsProcessingUtils.mapLayerFromString(args["input"], context, allowLoadingNewLayers=True)
+        with self.recorder.phase("area of interest"):
+            area = area_geometry(area_source, layer.crs(), context.transformContext())
+            margin = radius + max_link_length(layer)
+            feature_ids = set(features_near_area(layer, area, margin))
+            # Only the results of these links are exact; the rest are there to route through
+            self.area_link_ids = set(features_in_area(layer, area, feature_ids))
+        feedback.setProgressText(f"Keeping {len(feature_ids)} of {layer.featureCount()} links for the area of interest")
+        self.recorder.add(area_of_interest_links=len(feature_ids))
+        input_options = export_options["input"]
+        input_options.feature_ids = feature_ids
+        # The extent sizes the tile grid when the run is tiled
+        extent = area.buffer(margin, 8).boundingBox()
+        input_options.extent = extent if input_options.extent is None else input_options.extent.intersect(extent)
+        return area
+
+    def check_cost(self, args, export_options, tiles, max_processes, context, feedback):
+        """Estimate the runtime and peak memory of sDNA, warning or refusing if they exceed the limits.
+
+        The estimate is recorded with the run and report_cost adds what actually happened, so
+        later estimates are calibrated from this run.
+        """
+        layer = QgsProcessingUtils.mapLayerFromString(args["input"], context, allowLoadingNewLayers=True)
+        input_options = export_options["input"]
+        if input_options.feature_ids is not None:
+            links = len(input_options.feature_ids)
+        elif input_options.selected_only:
+            links = layer.selectedFeatureCount()
+        else:
+            links = layer.featureCount()
+        extent = layer.extent()
+        if input_options.extent is not None:
+            extent = extent.intersect(input_options.extent)
+        radius = max_radius(args.get("radii", ""))
+        features = cost_features(self.name(), str(args.get("metric", "")), links, radius, extent.width(), extent.height())
+        model = CostModel.load()
+        if tiles > 1:
+            self.cost = {"strategy": "tiled", "features": features, "estimate": model.estimate_tiled(features, tiles, max_processes)}
+        else:
+            self.cost = {"strategy": "whole", "features": features, "estimate": model.estimate(features)}
+        self.recorder.add(cost=self.cost)
+        estimate = self.cost["estimate"]
+        basis = f"calibrated from {estimate['calibrated_from']} past runs" if estimate["calibrated_from"] else "not yet calibrated"
+        feedback.setProgressText(
+            f"Estimated sDNA runtime {format_duration(estimate['wall_s'])}, peak memory {estimate['peak_mb']:.0f} MB ({basis})"
+        )
 
-        args = self.extract_args(parameters, context)
-        syntax = self.extract_syntax(args, context, feedback, source_crs)
+        runtime_limit, memory_limit = CostModel.limits()
+        exceeded = []
+        if runtime_limit is not None and estimate["wall_s"] > runtime_limit:
+            exceeded.append(f"the runtime limit of {format_duration(runtime_limit)}")
+        if memory_limit is not None and estimate["peak_mb"] > memory_limit:
+            exceeded.append(f"the memory limit of {memory_limit:.0f} MB")
+        if not exceeded:
+            return
+        recommendation = model.recommend(features, runtime_limit, memory_limit, os.cpu_count() or 1)
+        if recommendation:
+            advice = f"Try {recommendation[0]} tiles per side with at most {recommendation[1]} concurrent sDNA processes."
+        elif radius is None:
+            advice = "Runs with a global radius cannot be tiled; try finite radii or an area of interest."
+        else:
+            advice = "No tiling fits within the limits; try smaller radii or an area of interest."
+        message = f"This run is estimated to exceed {' and '.join(exceeded)}. {advice}"
+        if ProcessingConfig.getSetting(CostModel.REFUSE_SETTING):
+            raise QgsProcessingException(message)
+        feedback.setProgressText(f"WARNING: {message}")
+
+    def report_cost(self):
+        """Record the actual runtime and peak memory of sDNA beside the estimate made by check_cost."""
+        sdna_phases = [phase for phase in self.recorder.phases if phase["name"] == "sDNA"]
+        if self.cost is None or not sdna_phases or self.recorder.record.get("run_cache_hit"):
+            return
+        phase = sdna_phases[-1]
+        actual = {"wall_s": phase["wall_s"]}
+        if "children_peak_rss_mb" in phase:
+            actual["peak_mb"] = phase["children_peak_rss_mb"]
+        self.cost["actual"] = actual
+        self.recorder.add(cost=self.cost)
+        # Tiled runs are not comparable with the estimates the model makes, so only untiled runs calibrate it
+        if self.cost["strategy"] == "whole" and not CostModel.record(self.cost["features"], actual):
+            QgsMessageLog.logMessage("Could not record the cost of this run for later estimates", "sDNA")
+        estimate = self.cost["estimate"]
+        message = f"sDNA took {format_duration(actual['wall_s'])} (estimated {format_duration(estimate['wall_s'])})"
+        if "peak_mb" in actual:
+            message += f", peak memory {actual['peak_mb']:.0f} MB (estimated {estimate['peak_mb']:.0f} MB)"
+        QgsMessageLog.logMessage(message, "sDNA")
+
+    def process_whole(self, args, export_options, force_recompute, context, feedback, crs):
+        """Run sDNA once on the whole input and return its return value."""
+        syntax = self.extract_syntax(args, context, feedback, crs, export_options)
+        self.recorder.add(syntax=syntax)
 
         # print("ARGS:", args)
         # print("SYNTAX:", syntax)
 
-        retval = self.issue_sdna_command(syntax, feedback)
-        if retval != 0:
-            QgsMessageLog.logMessage("ERROR: PROCESS DID NOT COMPLETE SUCCESSFULLY", "SDNA")
-
-        # Return the results of the algorithm.
-        return_object = {
-            "OUTPUT": self.outputs[0]
-        }
-        return return_object
+        with self.recorder.phase("sDNA", self.sdna_processes([syntax])):
+            retval = self.run_cached(syntax, feedback, force_recompute)
+        if retval == 0:
+            with self.recorder.phase("outputs"):
+                self.recorder.add(output_feature_counts=self.count_output_features(syntax))
+        return retval
 
     def extract_args(self, parameters, context):
         args = {}
@@ -233,6 +748,9 @@ class SDNAAlgorithm(QgsProcessingAlgorithm):
         for vn in self.varnames:
             value = parameters[vn]
             value = None if type(value) == QVariant and value.isNull() else value  # Convert Qt's NULL into Python's None
+            if isinstance(value, QgsProcessingFeatureSourceDefinition):
+                # sDNA needs the layer itself; selection is honoured when the layer is exported
+                value = value.source.staticValue()
             args[vn] = value
             if vn in self.selectvaroptions:
                 args[vn] = self.selectvaroptions[vn][args[vn]]
@@ -241,33 +759,262 @@ class SDNAAlgorithm(QgsProcessingAlgorithm):
 
         return args
 
-    def extract_syntax(self, args, context, feedback, source_crs):
+    @staticmethod
+    def matrix_output_name(varname):
+        return f"{varname.upper()}_MATRIX"
+
+    def convert_matrix_outputs(self, args, feedback):
+        """Convert each CSV table output to a binary matrix, recording the index of each as an output."""
+        for outname in self.outputnames:
+            path = args.get(outname)
+            if outname in self.layeroutputnames or not path or not path.lower().endswith(".csv"):
+                continue
+            if not os.path.isfile(path):
+                continue
+            feedback.setProgressText(f"Converting {path} to a binary matrix")
+            try:
+                self.matrix_outputs[self.matrix_output_name(outname)] = convert_csv_to_matrix(path, feedback)
+            except InterruptedError:
+                return
+            except (OSError, ValueError) as e:
+                raise QgsProcessingException(f"Could not convert {path} to a binary matrix: {e}")
+
+    def write_back_key(self, parameters, context):
+        """Return the output field matching results to the write back layer, or None if not writing back.
+
+        Without a key field results are matched on feature ids, which only identify features
+        of the input layer's own data.
+        """
+        if not parameters.get(SDNAAlgorithm.WRITE_BACK_LAYER):
+            return None
+        key = self.parameterAsString(parameters, SDNAAlgorithm.WRITE_BACK_KEY, context)
+        if key:
+            return key
+        target = self.parameterAsVectorLayer(parameters, SDNAAlgorithm.WRITE_BACK_LAYER, context)
+        input_layer = self.parameterAsVectorLayer(parameters, "input", context)
+        if target is None or input_layer is None or not same_data(target, input_layer):
+            raise QgsProcessingException(
+                "Results are matched on feature ids only when writing back onto the input layer; "
+                "choose the field to match results on to write back onto another layer"
+            )
+        return SOURCE_ID_FIELD
+
+    @staticmethod
+    def earlier_result_fields(layer):
+        """Return the names of result fields written back onto layer by earlier runs."""
+        names = layer.customProperty(RESULT_FIELDS_PROPERTY) or []
+        # A list of one name can be read back from a project as a plain string
+        return [names] if isinstance(names, str) else list(names)
+
+    def write_back_results(self, parameters, context, args, export_options, feedback):
+        """Write the results in sDNA's line output onto the write back layer, if one is given."""
+        key_field = self.write_back_key(parameters, context)
+        if key_field is None:
+            return
+        layer_outputs = [name for name in self.layeroutputnames if args.get(name)]
+        if not layer_outputs:
+            raise QgsProcessingException("Writing results back needs a line output")
+        layer = self.parameterAsVectorLayer(parameters, SDNAAlgorithm.WRITE_BACK_LAYER, context)
+        input_layer = QgsProcessingUtils.mapLayerFromString(args["input"], context, allowLoadingNewLayers=True)
+        input_fields = input_layer.fields()
+        exported_field_names = [
+            input_fields.at(index).name() for index in export_options["input"].exported_field_indexes(input_layer)
+        ]
+        target = open_for_writing(layer)
+        with self.recorder.phase("write back"):
+            # Links outside an area of interest are only there to route through, and their results are not exact
+            flag_field = AREA_OF_INTEREST_FIELD if self.area_link_ids is not None else None
+            updated, written_fields = write_back(
+                args[layer_outputs[0]], target, key_field, exported_field_names, feedback, flag_field
+            )
+        feedback.setProgressText(f"Wrote results to {updated} features of {layer.name()}")
+        self.recorder.add(written_back=updated)
+        # The project's layer is refreshed in postProcessAlgorithm, which runs in the main thread
+        self.write_back_target = layer if target is not layer else None
+        self.written_result_fields = (layer, written_fields)
+
+    @staticmethod
+    def formatted_output_path(path, extension):
+        """Return where the shapefile output at path ends up once converted to the format with extension."""
+        root, _ = os.path.splitext(path)
+        return f"{root}.{extension}"
+
+    def transcode_outputs(self, parameters, context, args, feedback):
+        """Convert sDNA's shapefile line outputs to the chosen output format, replacing them in args."""
+        _, driver_name, extension = OUTPUT_FORMATS[self.parameterAsEnum(parameters, SDNAAlgorithm.OUTPUT_FORMAT, context)]
+        if extension == "shp":
+            return
+        for outname in self.layeroutputnames:
+            if args.get(outname):
+                with self.recorder.phase(f"convert {outname} to {extension}"):
+                    args[outname] = self.transcode_output(args[outname], driver_name, extension, context, feedback)
+
+    def transcode_output(self, path, driver_name, extension, context, feedback):
+        """Convert the shapefile output at path to another format, delete it and return the new path.
+
+        The converted output is loaded on completion in place of the shapefile.
+        """
+        destination = self.formatted_output_path(path, extension)
+        self.written_outputs.append(destination)
+        feedback.setProgressText(f"Converting {path} to {destination}")
+        transcode(path, destination, driver_name, feedback)
+        for part in shapefile_parts(path):
+            os.remove(part)
+        layers_to_load = context.layersToLoadOnCompletion()
+        if path in layers_to_load:
+            layers_to_load[destination] = layers_to_load.pop(path)
+            context.setLayersToLoadOnCompletion(layers_to_load)
+        return destination
+
+    def postProcessAlgorithm(self, context, feedback):
+        if self.written_result_fields is not None:
+            # Remembered so later runs leave these fields out of the input they give sDNA
+            layer, names = self.written_result_fields
+            earlier = self.earlier_result_fields(layer)
+            layer.setCustomProperty(RESULT_FIELDS_PROPERTY, earlier + [name for name in names if name not in earlier])
+            self.written_result_fields = None
+        if self.write_back_target is not None:
+            self.write_back_target.reload()
+            self.write_back_target.updateFields()
+            self.write_back_target.triggerRepaint()
+            self.write_back_target = None
+        return {}
+
+    def place_temporary_outputs(self, parameters, context, args, feature_count):
+        """Write temporary layer outputs to the scratch folder where they fit, and load them from there."""
+        layers_to_load = context.layersToLoadOnCompletion()
+        for outname in self.layeroutputnames:
+            value = parameters.get(outname)
+            if isinstance(value, QgsProcessingOutputLayerDefinition):
+                value = value.sink.staticValue()
+            if value != QgsProcessing.TEMPORARY_OUTPUT or not args.get(outname):
+                continue
+            path = self.scratch.output_path(
+                os.path.basename(args[outname]), estimate_shapefile_size(feature_count, SDNA_OUTPUT_FIELDS)
+            )
+            if path is None:
+                continue
+            if args[outname] in layers_to_load:
+                layers_to_load[path] = layers_to_load.pop(args[outname])
+            args[outname] = path
+        context.setLayersToLoadOnCompletion(layers_to_load)
+
+    def extract_export_options(self, parameters, context, args, crs):
+        """Work out how each input layer should be filtered when exported for sDNA."""
+        extent = None
+        if parameters.get(SDNAAlgorithm.EXTENT):
+            extent = self.parameterAsExtent(parameters, SDNAAlgorithm.EXTENT, context, crs)
+        prune_fields = self.parameterAsBool(parameters, SDNAAlgorithm.PRUNE_FIELDS, context)
+        write_back_key = self.write_back_key(parameters, context)
+
+        export_options = {}
+        for vn in self.layervarnames:
+            value = parameters.get(vn)
+            selected_only = isinstance(value, QgsProcessingFeatureSourceDefinition) and value.selectedFeaturesOnly
+            field_names = None
+            if prune_fields:
+                field_names = []
+                for field_vn, source in self.fieldvarsources.items():
+                    if source == vn and args.get(field_vn):
+                        field_names += [name.strip() for name in str(args[field_vn]).split(",") if name.strip()]
+            id_field = None
+            excluded_fields = None
+            if vn == "input" and (write_back_key == SOURCE_ID_FIELD or self.records_increment(parameters, context)):
+                id_field = SOURCE_ID_FIELD
+            if vn == "input" and write_back_key not in [None, SOURCE_ID_FIELD] and field_names is not None:
+                field_names.append(write_back_key)
+            if vn == "input" and write_back_key is not None:
+                # Results written back onto the input earlier must not reach sDNA as input fields,
+                # or they would be copied to its output in place of the new results
+                input_layer = self.parameterAsVectorLayer(parameters, vn, context)
+                if input_layer is not None:
+                    excluded_fields = self.earlier_result_fields(input_layer)
+            export_options[vn] = InputExportOptions(selected_only, extent, field_names, id_field, excluded_fields=excluded_fields)
+        export_options.setdefault("input", InputExportOptions())
+        return export_options
+
+    def extract_syntax(self, args, context, feedback, source_crs, export_options=None):
         # Convert inputs to shapefiles if necessary, renaming in syntax as appropriate
         syntax = self.algorithm_spec.getSyntax(args)
+        cache = ConversionCache.from_settings()
+        export_options = export_options or {}
+        options_by_path = {args[vn]: options for vn, options in export_options.items() if args.get(vn)}
         converted_inputs = {}
+        to_convert = {}
         for name, path in syntax["inputs"].items():
             if path:
                 _, file_extension = os.path.splitext(path.lower())
-                if not file_extension or file_extension not in [".shp", ".csv"]:
+                options = options_by_path.get(path, InputExportOptions())
+                if not file_extension or file_extension not in [".shp", ".csv"] or (file_extension == ".shp" and options.is_filtered()):
                     # If the input layer did not come from a shapefile or a CSV file or does not
-                    # have a file extension (in the case of a memory layer) we need to write the
-                    # contents of the layer to a temporary file so sDNA can read it as its input file.
-                    with tempfile.TemporaryDirectory() as tmp:
-                        temporary_filename = f"{tmp}.shp"
-                        feedback.setProgressText(f"Converting input layer to shapefile: {temporary_filename}")
-                        ret = QgsVectorFileWriter.writeAsVectorFormat(
-                            QgsProcessingUtils.mapLayerFromString(path, context, allowLoadingNewLayers=True),
-                            temporary_filename,
-                            "utf-8",
-                            source_crs,
-                            "ESRI Shapefile"
-                        )
-                        if ret != QgsVectorFileWriter.NoError:
-                            QgsMessageLog.logMessage("ERROR: COULD NOT WRITE TEMPORARY SHAPEFILE", "SDNA")
-                        converted_inputs[name] = temporary_filename
+                    # have a file extension (in the case of a memory layer), or only part of it is
+                    # wanted, we need to write the contents of the layer to a temporary file so sDNA
+                    # can read it as its input file.
+                    layer = QgsProcessingUtils.mapLayerFromString(path, context, allowLoadingNewLayers=True)
+                    to_convert[name] = (layer, options)
                 else:
                     converted_inputs[name] = path
-        syntax["inputs"] = converted_inputs
+        converted_inputs.update(self.convert_inputs(
+            to_convert, source_crs, context, cache, feedback,
+            while_converting=lambda: self.check_outputs(syntax, feedback)
+        ))
+        syntax["inputs"] = {name: converted_inputs[name] for name in syntax["inputs"] if name in converted_inputs}
+        return syntax
+
+    def convert_inputs(self, layers, crs, context, cache, feedback, while_converting=None):
+        """Convert each of a map of input names to (layer, options), returning the converted filenames.
+
+        Several inputs are converted at once, each from its own clone of the layer as a layer
+        must not be read from two threads at the same time. Each conversion reports through a
+        CombinedProgress, which is then the only thing touching feedback until they are done.
+        while_converting is called before the conversions start.
+        """
+        if len(layers) <= 1:
+            if while_converting:
+                while_converting()
+            converted = {}
+            for name, (layer, options) in layers.items():
+                with self.recorder.phase(f"convert {name}"):
+                    converted[name] = self.convert_input(layer, crs, context, cache, feedback, options)
+            return converted
+
+        combined_progress = CombinedProgress(feedback, len(layers), label="input")
+        jobs = []
+        for name, (layer, options) in layers.items():
+            # A clone does not carry unsaved edits, so a layer being edited is read directly
+            clone = layer if layer.isEditable() else layer.clone()
+            if clone is not layer and options.selected_only:
+                clone.selectByIds(layer.selectedFeatureIds())
+            jobs.append((name, clone, options))
+
+        def convert(index, name, layer, options):
+            progress = combined_progress.job_adaptor(index)
+            if progress.isCanceled():
+                return None
+            progress.setInfo(f"Converting {name} from {layer.name()}")
+            with self.recorder.phase(f"convert {name}"):
+                filename = self.convert_input(layer, crs, context, cache, progress, options, progress=progress)
+            progress.setPercentage(100)
+            return filename
+
+        if while_converting:
+            while_converting()
+        try:
+            with ThreadPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as executor:
+                futures = [executor.submit(convert, index, *job) for index, job in enumerate(jobs)]
+                return {name: future.result() for (name, _, _), future in zip(jobs, futures)}
+        finally:
+            combined_progress.close()
+
+    def count_output_features(self, syntax):
+        counts = {}
+        for name, path in syntax["outputs"].items():
+            if path and path.lower().endswith(".shp"):
+                layer = QgsVectorLayer(path, name, "ogr")
+                counts[name] = layer.featureCount() if layer.isValid() else None
+        return counts
+
+    def check_outputs(self, syntax, feedback):
         for name,path in syntax["outputs"].items():
             if path:
                 _, file_extension = os.path.splitext(path.lower())
@@ -277,20 +1024,385 @@ class SDNAAlgorithm(QgsProcessingAlgorithm):
                     feedback.setProgressText("ERROR: "+message)
                     QgsMessageLog.logMessage("ERROR: "+message, "SDNA")
                     raise Exception(message)
-        return syntax
+
+    def convert_input(self, layer, crs, context, cache, feedback, options=None, destination=None, progress=None):
+        """Write layer to a shapefile for sDNA, reusing a cached conversion where possible.
+
+        If progress is given, the percentage written is reported to it with setPercentage.
+        feedback need only have setProgressText and isCanceled, so on a pool thread it is
+        the JobProgressAdaptor for the conversion rather than the run's feedback.
+        """
+        options = options or InputExportOptions()
+        fields = layer.fields()
+        attributes = options.exported_field_indexes(layer)
+        if options.field_names is not None:
+            lower_names = [name.lower() for name in fields.names()]
+            missing = [name for name in options.field_names if name.lower() not in lower_names]
+            if missing:
+                feedback.setProgressText(f"WARNING: fields not found in {layer.name()}: {', '.join(missing)}")
+        feature_ids = options.exported_feature_ids(layer)
+
+        def write_features(filename, save_options):
+            # Features are read through a request on the layer itself, so unsaved edits are
+            # written and the user's selection and fields are untouched
+            output_fields = QgsFields()
+            for index in attributes:
+                output_fields.append(fields.at(index))
+            if options.id_field is not None:
+                output_fields.append(QgsField(options.id_field, QVariant.LongLong))
+            output_crs = crs if crs.isValid() else layer.crs()
+            writer = QgsVectorFileWriter.create(
+                filename, output_fields, layer.wkbType(), output_crs, context.transformContext(), save_options
+            )
+            if writer.hasError() != QgsVectorFileWriter.NoError:
+                return False
+            transform = None
+            if layer.crs() != output_crs:
+                transform = QgsCoordinateTransform(layer.crs(), output_crs, context.transformContext())
+            request = options.feature_request(layer).setSubsetOfAttributes(attributes)
+            total = max(1, len(feature_ids) if feature_ids is not None else layer.featureCount())
+            written = 0
+            chunk = []
+            for feature in layer.getFeatures(request):
+                output_feature = QgsFeature(output_fields)
+                if feature.hasGeometry():
+                    geometry = feature.geometry()
+                    if transform is not None:
+                        geometry.transform(transform)
+                    output_feature.setGeometry(geometry)
+                values = feature.attributes()
+                output_values = [values[index] for index in attributes]
+                if options.id_field is not None:
+                    output_values.append(feature.id())
+                output_feature.setAttributes(output_values)
+                chunk.append(output_feature)
+                if len(chunk) >= WRITE_CHUNK_SIZE:
+                    if feedback.isCanceled():
+                        del writer
+                        return False
+                    writer.addFeatures(chunk)
+                    written += len(chunk)
+                    chunk = []
+                    if progress is not None:
+                        progress.setPercentage(100 * written / total)
+            writer.addFeatures(chunk)
+            # Deleting the writer flushes the features
+            del writer
+            return True
+
+        def convert(filename):
+            feedback.setProgressText(f"Converting input layer to shapefile: {filename}")
+            save_options = QgsVectorFileWriter.SaveVectorOptions()
+            save_options.driverName = "ESRI Shapefile"
+            save_options.fileEncoding = "utf-8"
+            if options.id_field is not None or options.feature_ids is not None:
+                written = write_features(filename, save_options)
+            else:
+                if crs.isValid() and layer.crs() != crs:
+                    save_options.ct = QgsCoordinateTransform(layer.crs(), crs, context.transformContext())
+                save_options.onlySelectedFeatures = options.selected_only
+                if options.extent is not None:
+                    save_options.filterExtent = options.extent
+                if attributes:
+                    save_options.attributes = attributes
+                else:
+                    save_options.skipAttributeCreation = True
+                if progress is not None:
+                    conversion_feedback = QgsFeedback()
+
+                    def forward_progress(percentage):
+                        progress.setPercentage(percentage)
+                        if feedback.isCanceled():
+                            conversion_feedback.cancel()
+                    conversion_feedback.progressChanged.connect(forward_progress)
+                    save_options.feedback = conversion_feedback
+                ret = QgsVectorFileWriter.writeAsVectorFormatV2(
+                    layer,
+                    filename,
+                    context.transformContext(),
+                    save_options
+                )
+                # Depending on the QGIS version this returns a tuple starting with the error code
+                error = ret[0] if isinstance(ret, tuple) else ret
+                written = error == QgsVectorFileWriter.NoError
+            if not written:
+                QgsMessageLog.logMessage("ERROR: COULD NOT WRITE TEMPORARY SHAPEFILE", "SDNA")
+                return False
+            return True
+
+        key = None
+        if cache:
+            extra = {
+                "selected": sorted(feature_ids) if feature_ids is not None else None,
+                "extent": options.extent.toString() if options.extent is not None else None,
+                "id_field": options.id_field
+            }
+            key = cache.key(layer, crs, [fields.at(i).name() for i in attributes], extra)
+        if key:
+            cached_filename = cache.fetch(key, convert, feedback)
+            if cached_filename:
+                return cached_filename
+        if destination:
+            convert(destination)
+            return destination
+        size = estimate_shapefile_size(layer.featureCount(), len(attributes))
+        temporary_filename = self.scratch.path("input.shp", size)
+        if not convert(temporary_filename) and self.scratch.in_scratch(temporary_filename):
+            feedback.setProgressText("Input did not fit in the scratch folder, writing it to disk instead")
+            temporary_filename = self.scratch.path("input.shp", size, allow_scratch=False)
+            convert(temporary_filename)
+        return temporary_filename
+
+    def process_tiled(self, args, export_options, tiles_per_side, max_processes, context, feedback, crs):
+        """Run sDNA separately on buffered tiles of the input and stitch the core links of each together.
+
+        Tiles are buffered by the largest radius plus the longest link, which contains every
+        route of at most that radius passing through a link whose midpoint lies in the core
+        tile, so results for core links are the same as for an untiled run.
+        """
+        radius = max_radius(args.get("radii", ""))
+        layer_outputs = [name for name in self.layeroutputnames if args.get(name)]
+        other_outputs = [name for name in self.outputnames if name not in self.layeroutputnames and args.get(name)]
+        if radius is None or len(layer_outputs) != 1 or other_outputs:
+            raise QgsProcessingException(
+                "Tiling needs finite radii and a single line output with no table outputs"
+            )
+        output_name = layer_outputs[0]
+
+        layer = QgsProcessingUtils.mapLayerFromString(args["input"], context, allowLoadingNewLayers=True)
+        input_options = export_options["input"]
+        extent = layer.extent()
+        if input_options.extent is not None:
+            extent = extent.intersect(input_options.extent)
+        grid = TileGrid(extent, tiles_per_side, radius + max_link_length(layer))
+        other_export_options = {vn: options for vn, options in export_options.items() if vn != "input"}
+
+        # Buffered tiles overlap, so allow for the input twice over as well as the outputs
+        feature_count = layer.featureCount()
+        tile_folder = self.scratch.folder_path("tiles", (
+            2 * estimate_shapefile_size(feature_count, layer.fields().count())
+            + estimate_shapefile_size(feature_count, SDNA_OUTPUT_FIELDS)
+        ))
+        try:
+            syntaxes = {}
+            tile_outputs = {}
+            with self.recorder.phase("prepare tiles"):
+                for column, row in grid.tiles():
+                    tile = (column, row)
+                    if not grid.has_features(layer, tile, input_options.feature_ids):
+                        continue
+                    feedback.setProgressText(f"Preparing tile {column},{row}")
+                    tile_options = InputExportOptions(
+                        input_options.selected_only, grid.buffered_extent(tile), input_options.field_names,
+                        input_options.id_field, input_options.feature_ids, input_options.excluded_fields
+                    )
+                    tile_args = dict(args)
+                    tile_args["input"] = self.convert_input(
+                        layer, crs, context, None, feedback, tile_options,
+                        os.path.join(tile_folder, f"input_{column}_{row}.shp")
+                    )
+                    tile_args[output_name] = tile_outputs[tile] = os.path.join(tile_folder, f"output_{column}_{row}.shp")
+                    syntaxes[tile] = self.extract_syntax(tile_args, context, feedback, crs, other_export_options)
+            if not syntaxes:
+                raise QgsProcessingException("No features to analyse")
+
+            feedback.setProgressText(f"Running {len(syntaxes)} tiles with up to {max_processes} concurrent sDNA processes")
+            with self.recorder.phase("sDNA", self.sdna_processes(syntaxes.values())):
+                retvals = self.run_concurrently(list(syntaxes.values()), max_processes, feedback)
+            if any(retval != 0 for retval in retvals):
+                return 1
+            with self.recorder.phase("stitch tiles"):
+                if not stitch_outputs(tile_outputs, grid, args[output_name], crs, feedback):
+                    return 1
+            return 0
+        finally:
+            shutil.rmtree(tile_folder, ignore_errors=True)
+
+    def incremental_settings(self, args, crs):
+        """Return everything besides the input that must match for one run to update the output of another."""
+        settings = {
+            "algorithm": self.name(),
+            "args": {name: value for name, value in args.items() if name != "input" and name not in self.outputnames},
+            "crs": crs.authid()
+        }
+        # Compare as the settings will be read back from the store
+        return json.loads(json.dumps(settings, default=str))
+
+    def process_incremental(self, base, args, export_options, context, feedback, crs):
+        """Update base, an earlier output, rerunning sDNA only on the links that edits since can affect.
+
+        The input is compared with the record kept of the input behind base. Links within the
+        largest radius of an edit are rerun, with the same margin of context as a tile, and
+        their new results are merged with the earlier results of every other link. Returns
+        None if the whole network must be run instead.
+        """
+        radius = max_radius(args.get("radii", ""))
+        layer_outputs = [name for name in self.layeroutputnames if args.get(name)]
+        other_outputs = [name for name in self.outputnames if name not in self.layeroutputnames and args.get(name)]
+        if radius is None or len(layer_outputs) != 1 or other_outputs:
+            raise QgsProcessingException(
+                "Incremental re-analysis needs finite radii and a single line output with no table outputs"
+            )
+        store = IncrementalStore.from_settings()
+        if store is None:
+            raise QgsProcessingException("Incremental re-analysis needs a folder for its records in the sDNA provider settings")
+        record = store.load(base)
+        if record is None:
+            feedback.setProgressText(f"No record of the input behind {base}, so running the whole network")
+            return None
+        settings, previous = record
+        if settings != self.incremental_settings(args, crs):
+            feedback.setProgressText(f"{base} was written with different settings, so running the whole network")
+            return None
+        output_name = layer_outputs[0]
+
+        layer = QgsProcessingUtils.mapLayerFromString(args["input"], context, allowLoadingNewLayers=True)
+        input_options = export_options["input"]
+        with self.recorder.phase("find edits"):
+            self.input_fingerprints = layer_fingerprints(layer, input_options, feedback)
+            compared = self.recorded_fingerprints(self.input_fingerprints)
+            matches, edited = diff_fingerprints(previous, compared)
+            # With an area of interest only links in it were recorded, and only they need results
+            affected, needed = affected_features(
+                self.input_fingerprints, edited, radius, radius + max_link_length(layer), self.area_link_ids
+            )
+        self.recorder.add(edits=len(edited), affected_links=len(affected), rerun_links=len(needed))
+        feedback.setProgressText(f"{len(edited)} edits affect {len(affected)} links; rerunning sDNA on {len(needed)} links")
+        if len(needed) > FULL_RUN_FRACTION * len(self.input_fingerprints):
+            feedback.setProgressText("Edits affect too much of the network, so running the whole network")
+            return None
+
+        partial_output = None
+        if affected:
+            subset_options = InputExportOptions(
+                False, None, input_options.field_names, SOURCE_ID_FIELD, needed, input_options.excluded_fields
+            )
+            partial_args = dict(args)
+            partial_args["input"] = self.convert_input(
+                layer, crs, context, None, feedback, subset_options,
+                self.scratch.path("increment_input.shp", estimate_shapefile_size(len(needed), layer.fields().count()))
+            )
+            partial_args[output_name] = partial_output = self.scratch.path(
+                "increment_output.shp", estimate_shapefile_size(len(needed), SDNA_OUTPUT_FIELDS)
+            )
+            other_export_options = {vn: options for vn, options in export_options.items() if vn != "input"}
+            syntax = self.extract_syntax(partial_args, context, feedback, crs, other_export_options)
+            with self.recorder.phase("sDNA", self.sdna_processes([syntax])):
+                retval = self.run_cached(syntax, feedback)
+            if retval != 0:
+                return retval
+
+        with self.recorder.phase("merge"):
+            merged_path = self.scratch.path(
+                "merged.shp", estimate_shapefile_size(len(self.input_fingerprints), SDNA_OUTPUT_FIELDS)
+            )
+            if not merge_outputs(base, partial_output, matches, affected, args[output_name], merged_path, crs, feedback):
+                return 1
+        return 0
+
+    def records_increment(self, parameters, context):
+        """Whether the input is recorded so the line output can be updated incrementally later.
+
+        Recording exports each feature's id with the input and fingerprints every feature, so
+        is only done when asked for, or when updating an earlier output so that the update can
+        be updated in turn.
+        """
+        asked = bool(parameters.get(SDNAAlgorithm.RECORD_INCREMENTAL)) and self.parameterAsBool(
+            parameters, SDNAAlgorithm.RECORD_INCREMENTAL, context
+        )
+        if not asked and not parameters.get(SDNAAlgorithm.INCREMENTAL_BASE):
+            return False
+        if IncrementalStore.from_settings() is None:
+            raise QgsProcessingException("Incremental re-analysis needs a folder for its records in the sDNA provider settings")
+        return True
+
+    def recorded_fingerprints(self, fingerprints):
+        """Return the fingerprints of the links whose results are exact, leaving out those outside an area of interest."""
+        if self.area_link_ids is None:
+            return fingerprints
+        return {fid: value for fid, value in fingerprints.items() if fid in self.area_link_ids}
+
+    def record_increment(self, args, export_options, context, feedback, crs):
+        """Record the input behind the line output, so a later run can update the output incrementally."""
+        store = IncrementalStore.from_settings()
+        layer_outputs = [name for name in self.layeroutputnames if args.get(name)]
+        if len(layer_outputs) != 1:
+            feedback.setProgressText("WARNING: only runs with a single line output can be recorded for incremental re-analysis")
+            return
+        with self.recorder.phase("record increment"):
+            fingerprints = self.input_fingerprints
+            if fingerprints is None:
+                layer = QgsProcessingUtils.mapLayerFromString(args["input"], context, allowLoadingNewLayers=True)
+                fingerprints = layer_fingerprints(layer, export_options["input"], feedback)
+            fingerprints = self.recorded_fingerprints(fingerprints)
+            if not store.save(args[layer_outputs[0]], self.incremental_settings(args, crs), fingerprints):
+                QgsMessageLog.logMessage("Could not record input for incremental re-analysis", "sDNA")
+
+    def run_cached(self, syntax, feedback, force_recompute=False):
+        """Restore the outputs of an identical earlier run if the run cache is enabled, otherwise run sDNA."""
+        run_cache = RunCache.from_settings()
+        if not run_cache:
+            return self.issue_sdna_command(syntax, feedback)
+        key = run_cache.key(syntax, self.sdna_path)
+        if not force_recompute and run_cache.restore(key, syntax["outputs"], feedback):
+            self.recorder.add(run_cache_hit=True)
+            return 0
+        retval = self.issue_sdna_command(syntax, feedback)
+        if retval == 0 and not run_cache.save(key, syntax["outputs"]):
+            QgsMessageLog.logMessage("Could not store outputs in run cache", "sDNA")
+        return retval
+
+    def run_concurrently(self, syntaxes, max_processes, feedback):
+        """Run sDNA once for each syntax, at most max_processes at a time, returning each return value.
+
+        Runs that have not started when the user cancels are skipped and return None.
+        """
+        combined_progress = CombinedProgress(feedback, len(syntaxes))
+
+        def run(index, syntax):
+            if feedback.isCanceled() or self.limits.exceeded:
+                return None
+            pythonexe, pythonpath = self.get_qgis_python_installation()
+            with SDNAProcessWatchdog(feedback, syntax, self.limits):
+                return self.run_sdna_command(syntax, self.sdna_path, combined_progress.job_adaptor(index), pythonexe, pythonpath)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_processes) as executor:
+                futures = [executor.submit(run, index, syntax) for index, syntax in enumerate(syntaxes)]
+                return [future.result() for future in futures]
+        finally:
+            combined_progress.finish(self.name())
+
+    @staticmethod
+    def sdna_processes(syntaxes):
+        """Return a function listing the processes running syntaxes, so the recorder measures only those."""
+        markers = [run_marker(syntax) for syntax in syntaxes]
+        return lambda: run_processes(markers)
 
     def issue_sdna_command(self, syntax, feedback):
         pythonexe, pythonpath = self.get_qgis_python_installation()
         sdna_command_path = self.sdna_path[:-5]
-        progress_adapter = ProgressAdaptor(feedback)
-        return self.run_sdna_command(syntax, self.sdna_path, progress_adapter, pythonexe, pythonpath)
+        progress_adapter = ProgressAdaptor.from_settings(feedback)
+        try:
+            # The worker's processes are not the run's own, so resource limits cannot be applied to them
+            worker = None if self.limits.is_active() else self.sdna_worker()
+            if worker:
+                retval = worker.try_run(syntax, self.sdna_path, progress_adapter, feedback, pythonexe, pythonpath)
+                if retval is not None:
+                    return retval
+                progress_adapter.setInfo("sDNA worker is busy or unavailable, starting a separate sDNA process")
+            with SDNAProcessWatchdog(feedback, syntax, self.limits):
+                return self.run_sdna_command(syntax, self.sdna_path, progress_adapter, pythonexe, pythonpath)
+        finally:
+            progress_adapter.finish(self.name())
+
+    def sdna_worker(self):
+        """Return the provider's persistent sDNA worker, or None if it is disabled or unavailable."""
+        get_sdna_worker = getattr(self.provider(), "get_sdna_worker", None)
+        return get_sdna_worker() if get_sdna_worker else None
 
     def get_qgis_python_installation(self):
-        qgisbase = os.path.dirname(os.path.dirname(sys.executable))
-        pythonexe = os.path.join(qgisbase, "bin", "python3.exe")
-        pythonbase = os.path.join(qgisbase, "apps", "python27")
-        pythonpath = ";".join([os.path.join(pythonbase, x) for x in ["", "Lib", "Lib/site-packages"]])
-        return pythonexe, pythonpath
+        return qgis_python_installation()
 
     def name(self):
         """The name of this algorithm. Should not be localised."""
@@ -319,14 +1431,153 @@ class SDNAAlgorithm(QgsProcessingAlgorithm):
         return SDNAAlgorithm(self.algorithm_spec, self.sdna_path, self.run_sdna_command)
 
 
+class CombinedProgress:
+    """Combines the progress of several concurrent sDNA runs or conversions into one feedback object."""
+
+    def __init__(self, feedback, job_count, label="run"):
+        self.progress_adaptor = ProgressAdaptor.from_settings(feedback)
+        self.percentages = [0] * job_count
+        self.label = label
+        self.lock = threading.Lock()
+
+    def job_adaptor(self, index):
+        return JobProgressAdaptor(self, index)
+
+    def set_info(self, index, info):
+        self.progress_adaptor.setInfo(f"[{self.label} {index + 1}] {info}")
+
+    def set_percentage(self, index, percentage):
+        with self.lock:
+            self.percentages[index] = percentage
+            overall = sum(self.percentages) / len(self.percentages)
+        self.progress_adaptor.setPercentage(overall)
+
+    def is_canceled(self):
+        return self.progress_adaptor.isCanceled()
+
+    def close(self):
+        self.progress_adaptor.close()
+
+    def finish(self, name):
+        self.progress_adaptor.finish(name)
+
+
+class JobProgressAdaptor:
+    """Stands in for ProgressAdaptor for one of several runs reporting to a CombinedProgress."""
+
+    def __init__(self, combined_progress, index):
+        self.combined_progress = combined_progress
+        self.index = index
+
+    def setInfo(self, info):
+        self.combined_progress.set_info(self.index, info)
+
+    def setPercentage(self, percentage):
+        self.combined_progress.set_percentage(self.index, percentage)
+
+    def setProgressText(self, text):
+        self.setInfo(text)
+
+    def isCanceled(self):
+        return self.combined_progress.is_canceled()
+
+
 class ProgressAdaptor:
+    """Passes sDNA's progress messages on to a QgsProcessingFeedback.
+
+    sDNA calls setInfo and setPercentage from the loop reading its output pipe, so these only
+    record the message and return. A background thread forwards pending text in batches and
+    the latest percentage once per interval, which stops a flood of messages making the
+    Processing dialog the bottleneck, and shows the last messages before a quiet phase
+    without waiting for the next one. With an interval of 0 every message is forwarded as it
+    comes. The most recent messages are kept so the full log can be written to a file after
+    the run.
+    """
+
+    INTERVAL_SETTING = "SDNA_PROGRESS_INTERVAL_SETTING"
+    LOG_FOLDER_SETTING = "SDNA_LOG_FOLDER_SETTING"
+    LOG_LINES = 100000
 
-    def __init__(self, feedback):
+    def __init__(self, feedback, interval=0.5, log_folder=None, log_lines=LOG_LINES):
         self.feedback = feedback
+        self.interval = interval
+        self.log_folder = log_folder
+        self.log = collections.deque(maxlen=log_lines)
+        self.pending_text = []
+        self.pending_percentage = None
+        self.lock = threading.Lock()
+        # Held while calling feedback, which is not safe to use from two threads at once
+        self.feedback_lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = None
+
+    @classmethod
+    def from_settings(cls, feedback):
+        interval_ms = ProcessingConfig.getSetting(cls.INTERVAL_SETTING)
+        interval = 0.5 if interval_ms is None else max(0, int(interval_ms)) / 1000
+        return cls(feedback, interval, ProcessingConfig.getSetting(cls.LOG_FOLDER_SETTING) or None)
 
     def setInfo(self, info):
-        self.feedback.setProgressText(info)
+        with self.lock:
+            self.log.append(info)
+            self.pending_text.append(info)
+        self.forward()
 
     def setPercentage(self, percentage):
-        self.feedback.setProgress(percentage)
+        with self.lock:
+            self.pending_percentage = percentage
+        self.forward()
+
+    def forward(self):
+        """Forward now if there is no interval, otherwise make sure the forwarding thread is running."""
+        if self.interval <= 0:
+            self.flush()
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            text = "\n".join(self.pending_text)
+            percentage = self.pending_percentage
+            self.pending_text = []
+            self.pending_percentage = None
+        with self.feedback_lock:
+            if text:
+                self.feedback.setProgressText(text)
+            if percentage is not None:
+                self.feedback.setProgress(percentage)
+
+    def isCanceled(self):
+        with self.feedback_lock:
+            return self.feedback.isCanceled()
+
+    def dump(self, path):
+        with self.lock:
+            lines = list(self.log)
+        with open(path, "w", encoding="utf-8") as log_file:
+            log_file.write("\n".join(lines) + "\n")
+
+    def close(self):
+        """Stop the forwarding thread and forward anything still pending."""
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def finish(self, name):
+        """Forward anything still pending and write the log to the log folder if one is set."""
+        self.close()
+        if self.log_folder:
+            os.makedirs(self.log_folder, exist_ok=True)
+            filename = "".join(c if c.isalnum() else "_" for c in name)
+            path = os.path.join(self.log_folder, f"{filename}_{time.strftime('%Y%m%d_%H%M%S')}.log")
+            self.dump(path)
+            self.feedback.setProgressText(f"sDNA log written to {path}")
     
\ No newline at end of file
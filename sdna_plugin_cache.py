@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from qgis.core import QgsMessageLog
+from processing.core.ProcessingConfig import ProcessingConfig
+
+
+def folder_size(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            try:
+                total += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+    return total
+
+
+def hash_description(description):
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+SHAPEFILE_EXTENSIONS = [".shp", ".shx", ".dbf", ".prj", ".cpg", ".qpj"]
+# Bytes of a DBF header holding the date the file was last written
+DBF_DATE_BYTES = slice(1, 4)
+
+
+def shapefile_parts(path):
+    """Return the files making up the shapefile or other file at path that actually exist."""
+    root, extension = os.path.splitext(path)
+    if extension.lower() != ".shp":
+        return [path] if os.path.isfile(path) else []
+    return [root + part for part in SHAPEFILE_EXTENSIONS if os.path.isfile(root + part)]
+
+
+class FolderCache:
+    """Size-bounded cache storing each entry in its own folder.
+
+    Entry folders are named after a hash of everything that determines their content. The
+    folder's modification time records when the entry was last used, and the least recently
+    used entries are evicted once the cache grows past its size limit.
+    """
+
+    FOLDER_SETTING = None
+    MAX_SIZE_SETTING = None
+
+    def __init__(self, folder, max_size_mb):
+        self.folder = folder
+        self.max_size = max_size_mb * 1024 * 1024
+
+    @classmethod
+    def from_settings(cls):
+        """Return the cache configured in the provider settings, or None if caching is disabled."""
+        folder = ProcessingConfig.getSetting(cls.FOLDER_SETTING)
+        if not folder:
+            return None
+        max_size_mb = int(ProcessingConfig.getSetting(cls.MAX_SIZE_SETTING) or 0)
+        if max_size_mb <= 0:
+            return None
+        return cls(folder, max_size_mb)
+
+    def entry_folder(self, key):
+        """Return the folder of the entry for key, marking it as used, or None if there is no such entry."""
+        entry = os.path.join(self.folder, key)
+        if not os.path.isdir(entry):
+            return None
+        now = time.time()
+        os.utime(entry, (now, now))
+        return entry
+
+    def store(self, key, populate):
+        """Create the entry for key by calling populate(folder), which returns True on success."""
+        os.makedirs(self.folder, exist_ok=True)
+        staging = os.path.join(self.folder, f"{key}.tmp-{os.getpid()}-{time.time_ns()}")
+        os.makedirs(staging)
+        try:
+            if not populate(staging):
+                return None
+            entry = os.path.join(self.folder, key)
+            try:
+                os.replace(staging, entry)
+            except OSError:
+                # Another run stored the same entry first; theirs is as good as ours
+                if not os.path.isdir(entry):
+                    raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict(keep=key)
+        return self.entry_folder(key)
+
+    def evict(self, keep=None):
+        """Delete the least recently used entries until the cache fits within its size limit."""
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return
+        entries = []
+        for name in names:
+            entry = os.path.join(self.folder, name)
+            if os.path.isdir(entry) and ".tmp-" not in name:
+                entries.append((os.path.getmtime(entry), folder_size(entry), name, entry))
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, name, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            QgsMessageLog.logMessage(f"Evicted cache entry {name} from {self.folder}", "sDNA")
+
+
+class ConversionCache(FolderCache):
+    """Persistent cache of input layers converted to shapefiles for sDNA."""
+
+    FOLDER_SETTING = "SDNA_CONVERSION_CACHE_FOLDER_SETTING"
+    MAX_SIZE_SETTING = "SDNA_CONVERSION_CACHE_MAX_SIZE_SETTING"
+    SHAPEFILE_NAME = "input.shp"
+
+    @staticmethod
+    def modification_stamp(layer):
+        """Return something that changes whenever the layer's data does, or None if there is no such thing.
+
+        Only layers stored in files have such a stamp. Unsaved edits leave the file untouched,
+        and database and memory layers can change without any trace we can see, so none of
+        these are ever cached.
+        """
+        if layer.isModified():
+            return None
+        path = layer.source().split("|")[0]
+        if not os.path.isfile(path):
+            return None
+        stamp = []
+        for candidate in [path, path + "-wal"]:
+            if os.path.isfile(candidate):
+                stat = os.stat(candidate)
+                stamp.append([stat.st_mtime_ns, stat.st_size])
+        return stamp
+
+    def key(self, layer, crs, field_names, extra=None):
+        """Return the cache key for converting the layer, or None if the layer cannot be cached."""
+        stamp = self.modification_stamp(layer)
+        if stamp is None:
+            return None
+        description = {
+            "source": layer.source(),
+            "provider": layer.providerType(),
+            "subset": layer.subsetString(),
+            "stamp": stamp,
+            "feature_count": layer.featureCount(),
+            "crs": crs.toWkt() if crs.isValid() else "",
+            "fields": list(field_names),
+            "extra": extra
+        }
+        return hash_description(description)
+
+    def lookup(self, key):
+        entry = self.entry_folder(key)
+        if not entry:
+            return None
+        path = os.path.join(entry, ConversionCache.SHAPEFILE_NAME)
+        return path if os.path.isfile(path) else None
+
+    def fetch(self, key, convert, feedback):
+        """Return the cached shapefile for key, calling convert(path) to create it on a miss.
+
+        convert must return True if it wrote the shapefile successfully.
+        """
+        path = self.lookup(key)
+        if path:
+            feedback.setProgressText(f"Conversion cache hit: {path}")
+            return path
+        feedback.setProgressText(f"Conversion cache miss: {key}")
+        entry = self.store(key, lambda folder: convert(os.path.join(folder, ConversionCache.SHAPEFILE_NAME)))
+        return os.path.join(entry, ConversionCache.SHAPEFILE_NAME) if entry else None
+
+
+def sdna_install_fingerprint(sdna_path):
+    """Return a hash identifying the sDNA installation, which changes whenever sDNA is upgraded."""
+    bin_folder = sdna_path.strip('"')
+    description = [bin_folder]
+    for folder in [bin_folder, os.path.dirname(bin_folder)]:
+        try:
+            names = sorted(os.listdir(folder))
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(folder, name)
+            if os.path.isfile(path) and os.path.splitext(name)[1].lower() in [".dll", ".so", ".py", ".exe"]:
+                stat = os.stat(path)
+                description.append([name, stat.st_size, stat.st_mtime_ns])
+    return hash_description(description)
+
+
+class RunCache(FolderCache):
+    """Persistent cache of sDNA outputs, so runs identical to an earlier one are restored rather than recomputed.
+
+    Entries are keyed on the sDNA syntax with input files replaced by hashes of their content,
+    so converted inputs and renamed copies of the same data still hit the cache.
+    """
+
+    FOLDER_SETTING = "SDNA_RUN_CACHE_FOLDER_SETTING"
+    MAX_SIZE_SETTING = "SDNA_RUN_CACHE_MAX_SIZE_SETTING"
+    MANIFEST_NAME = "manifest.json"
+    # Renamed when the way files are hashed changes, so hashes made the old way are not reused
+    FILE_HASHES_NAME = "file_hashes_2.json"
+
+    def file_hash(self, path):
+        """Hash the content of path and its shapefile parts, remembering hashes of unchanged files.
+
+        The date in a DBF header is left out, so an input converted again on another day, as
+        memory and database layers are on every run, still hashes the same.
+        """
+        memo_path = os.path.join(self.folder, RunCache.FILE_HASHES_NAME)
+        try:
+            with open(memo_path) as memo_file:
+                memo = json.load(memo_file)
+        except (OSError, ValueError):
+            memo = {}
+        digest = hashlib.sha1()
+        for part in shapefile_parts(path):
+            stat = os.stat(part)
+            stamp = f"{os.path.abspath(part)}|{stat.st_size}|{stat.st_mtime_ns}"
+            if stamp not in memo:
+                part_digest = hashlib.sha1()
+                with open(part, "rb") as part_file:
+                    if part.lower().endswith(".dbf"):
+                        header = bytearray(part_file.read(DBF_DATE_BYTES.stop))
+                        header[DBF_DATE_BYTES] = bytes(len(header[DBF_DATE_BYTES]))
+                        part_digest.update(header)
+                    for block in iter(lambda: part_file.read(1024 * 1024), b""):
+                        part_digest.update(block)
+                memo[stamp] = part_digest.hexdigest()
+            digest.update(os.path.splitext(part)[1].lower().encode("utf-8"))
+            digest.update(memo[stamp].encode("utf-8"))
+        # Forget files that have since been deleted so the memo does not grow forever
+        memo = {stamp: value for stamp, value in memo.items() if os.path.exists(stamp.split("|")[0])}
+        os.makedirs(self.folder, exist_ok=True)
+        with open(memo_path, "w") as memo_file:
+            json.dump(memo, memo_file)
+        return digest.hexdigest()
+
+    def key(self, syntax, sdna_path):
+        description = {
+            "command": syntax["command"],
+            "config": syntax["config"],
+            "inputs": {name: self.file_hash(path) if path else "" for name, path in syntax["inputs"].items()},
+            "outputs": {name: os.path.splitext(path)[1].lower() if path else "" for name, path in syntax["outputs"].items()},
+            "sdna": sdna_install_fingerprint(sdna_path)
+        }
+        return hash_description(description)
+
+    def save(self, key, outputs):
+        """Store copies of the output files written by a successful run."""
+
+        def populate(folder):
+            manifest = {}
+            for name, path in outputs.items():
+                if not path:
+                    continue
+                parts = shapefile_parts(path)
+                if not parts:
+                    return False
+                os.makedirs(os.path.join(folder, name))
+                for part in parts:
+                    shutil.copy2(part, os.path.join(folder, name, os.path.basename(part)))
+                manifest[name] = os.path.basename(path)
+            with open(os.path.join(folder, RunCache.MANIFEST_NAME), "w") as manifest_file:
+                json.dump(manifest, manifest_file)
+            return True
+
+        return self.store(key, populate) is not None
+
+    def restore(self, key, outputs, feedback):
+        """Copy the stored outputs for key to the requested output paths, returning False on a miss."""
+        entry = self.entry_folder(key)
+        if not entry:
+            feedback.setProgressText(f"Run cache miss: {key}")
+            return False
+        with open(os.path.join(entry, RunCache.MANIFEST_NAME)) as manifest_file:
+            manifest = json.load(manifest_file)
+        for name, path in outputs.items():
+            if not path:
+                continue
+            stored_root = os.path.splitext(os.path.join(entry, name, manifest[name]))[0]
+            root = os.path.splitext(path)[0]
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            for part in shapefile_parts(os.path.join(entry, name, manifest[name])):
+                shutil.copy2(part, root + part[len(stored_root):])
+        feedback.setProgressText(f"Run cache hit: restored outputs of an identical earlier run ({key})")
+        return True
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import collections
+import json
+import math
+import os
+
+from qgis.core import QgsApplication
+from processing.core.ProcessingConfig import ProcessingConfig
+
+from .sdna_plugin_instrumentation import MB
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+CALIBRATION_FILE = "cost_calibration.jsonl"
+# Fewer recorded runs than this are not enough to fit a model to
+MIN_RECORDS = 3
+# Only the most recent runs recorded are used, so the model follows changes in sDNA and hardware
+MAX_RECORDS = 2000
+# Once the calibration file grows past this it is cut back to the most recent MAX_RECORDS runs
+MAX_CALIBRATION_FILE_SIZE = 2 * MB
+# Used until enough runs have been recorded; roughly sDNA integral on a desktop machine
+DEFAULT_SECONDS_PER_WORK = 2e-7
+DEFAULT_BASE_MB = 100
+DEFAULT_MB_PER_LINK = 0.002
+MAX_RECOMMENDED_TILES = 16
+
+
+def available_memory_mb():
+    """Return the physical memory available to new processes in MB, or None if it cannot be found."""
+    if psutil:
+        return psutil.virtual_memory().available / MB
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def calibration_path():
+    """Return the file recording the cost of past runs, kept with the user's QGIS settings."""
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), "sdna", CALIBRATION_FILE)
+
+
+def format_duration(seconds):
+    if seconds >= 3600:
+        return f"{int(seconds // 3600)}h {int(seconds % 3600 // 60)}m"
+    if seconds >= 60:
+        return f"{int(seconds // 60)}m {int(seconds % 60)}s"
+    return f"{seconds:.1f}s"
+
+
+def cost_features(algorithm, metric, links, radius, width, height):
+    """Describe a run by what drives its cost.
+
+    The work of a run is the number of links times the number of links within the radius of
+    each, found by assuming the links are spread evenly over a width by height extent. With
+    a global radius (None) every link is within reach of every other.
+    """
+    area = width * height
+    if radius is None or area <= 0:
+        reachable = links
+    else:
+        reachable = min(links, max(1.0, links * math.pi * radius ** 2 / area))
+    return {
+        "algorithm": algorithm,
+        "metric": metric,
+        "links": links,
+        "radius": radius,
+        "width": width,
+        "height": height,
+        "work": links * reachable
+    }
+
+
+def tile_features(features, tiles_per_side):
+    """Return the features of one tile of a run split into tiles_per_side tiles along each side.
+
+    Each tile is buffered by the radius, as the tiled run does, so holds more than its share of links.
+    """
+    width, height, radius = features["width"], features["height"], features["radius"] or 0
+    if width <= 0 or height <= 0:
+        return features
+    fraction = min(1.0, (width / tiles_per_side + 2 * radius) * (height / tiles_per_side + 2 * radius) / (width * height))
+    tile = dict(features)
+    tile["links"] = features["links"] * fraction
+    # Link density is unchanged, so each link reaches as many others as before
+    tile["work"] = features["work"] * fraction
+    return tile
+
+
+def fit_power_law(xs, ys):
+    """Fit y = a * x ** b by least squares on logarithms, returning (a, b)."""
+    points = [(math.log(x), math.log(y)) for x, y in zip(xs, ys) if x > 0 and y > 0]
+    if not points:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return math.exp(mean_y - mean_x), 1.0
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+    # Keep the exponent physically sensible when there are few or noisy runs
+    slope = min(2.5, max(0.5, slope))
+    return math.exp(mean_y - slope * mean_x), slope
+
+
+def fit_line(xs, ys):
+    """Fit y = a + b * x by least squares, returning (a, b) with neither negative."""
+    count = len(xs)
+    mean_x = sum(xs) / count
+    mean_y = sum(ys) / count
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if variance == 0:
+        return 0.0, mean_y / mean_x if mean_x else 0.0
+    slope = max(0.0, sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance)
+    return max(0.0, mean_y - slope * mean_x), slope
+
+
+class CostModel:
+    """Estimates the runtime and peak memory of sDNA runs from the past runs recorded with record.
+
+    Runtime is fitted as a power of the work of a run, and peak memory as a linear function of
+    its links, to runs of the same tool and metric, or of the same tool if there are too few
+    of those. Only untiled runs that really ran sDNA are used. Without enough runs, rough
+    defaults are used instead.
+    """
+
+    RUNTIME_LIMIT_SETTING = "SDNA_RUNTIME_LIMIT_SETTING"
+    MEMORY_LIMIT_SETTING = "SDNA_MEMORY_LIMIT_SETTING"
+    REFUSE_SETTING = "SDNA_REFUSE_OVER_LIMIT_SETTING"
+
+    def __init__(self, records):
+        self.records = records
+
+    @staticmethod
+    def load(path=None):
+        """Return a model calibrated from the most recent runs in the calibration file at path."""
+        path = path or calibration_path()
+        try:
+            with open(path, encoding="utf-8") as calibration:
+                lines = collections.deque(calibration, maxlen=MAX_RECORDS)
+        except OSError:
+            return CostModel([])
+        records = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and "features" in record and "actual" in record:
+                records.append((record["features"], record["actual"]))
+        return CostModel(records)
+
+    @staticmethod
+    def record(features, actual, path=None):
+        """Add the actual cost of a successful untiled run to the calibration file, returning False if it cannot be written."""
+        path = path or calibration_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a", encoding="utf-8") as calibration:
+                calibration.write(json.dumps({"features": features, "actual": actual}) + "\n")
+            if os.path.getsize(path) > MAX_CALIBRATION_FILE_SIZE:
+                with open(path, encoding="utf-8") as calibration:
+                    lines = collections.deque(calibration, maxlen=MAX_RECORDS)
+                # Written in full and then moved into place, so the file is never left half written
+                temporary_path = f"{path}.tmp-{os.getpid()}"
+                with open(temporary_path, "w", encoding="utf-8") as calibration:
+                    calibration.writelines(lines)
+                os.replace(temporary_path, path)
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def limits():
+        """Return the runtime limit in seconds and memory limit in MB, either of which may be None."""
+        runtime_minutes = float(ProcessingConfig.getSetting(CostModel.RUNTIME_LIMIT_SETTING) or 0)
+        memory_mb = float(ProcessingConfig.getSetting(CostModel.MEMORY_LIMIT_SETTING) or 0)
+        return (runtime_minutes * 60 if runtime_minutes > 0 else None), (memory_mb if memory_mb > 0 else available_memory_mb())
+
+    def calibration_records(self, features):
+        same_tool = [record for record in self.records if record[0].get("algorithm") == features["algorithm"]]
+        same_metric = [record for record in same_tool if record[0].get("metric") == features["metric"]]
+        return same_metric if len(same_metric) >= MIN_RECORDS else same_tool
+
+    def estimate(self, features):
+        """Return the estimated wall time in seconds and peak memory in MB of a run with features."""
+        records = self.calibration_records(features)
+        runtime_fit = memory_fit = None
+        if len(records) >= MIN_RECORDS:
+            runtime_fit = fit_power_law([f["work"] for f, _ in records], [actual["wall_s"] for _, actual in records])
+            with_memory = [(f["links"], actual["peak_mb"]) for f, actual in records if actual.get("peak_mb")]
+            if len(with_memory) >= MIN_RECORDS:
+                memory_fit = fit_line(*zip(*with_memory))
+        a, b = runtime_fit or (DEFAULT_SECONDS_PER_WORK, 1.0)
+        base, per_link = memory_fit or (DEFAULT_BASE_MB, DEFAULT_MB_PER_LINK)
+        return {
+            "wall_s": round(a * max(1.0, features["work"]) ** b, 1),
+            "peak_mb": round(base + per_link * features["links"], 1),
+            "calibrated_from": len(records) if runtime_fit else 0
+        }
+
+    def estimate_tiled(self, features, tiles_per_side, max_processes):
+        """Estimate a run split into tiles, up to max_processes of which run at once."""
+        tile = self.estimate(tile_features(features, tiles_per_side))
+        tile_count = tiles_per_side ** 2
+        concurrent = max(1, min(max_processes, tile_count))
+        return {
+            "wall_s": round(tile["wall_s"] * math.ceil(tile_count / concurrent), 1),
+            "peak_mb": round(tile["peak_mb"] * concurrent, 1),
+            "calibrated_from": tile["calibrated_from"]
+        }
+
+    def recommend(self, features, runtime_limit, memory_limit, cpus):
+        """Return the fewest tiles per side and a number of processes that fit within the limits, or None."""
+        if features["radius"] is None:
+            return None
+        for tiles_per_side in range(2, MAX_RECOMMENDED_TILES + 1):
+            tile = self.estimate(tile_features(features, tiles_per_side))
+            processes = min(cpus, tiles_per_side ** 2)
+            if memory_limit is not None:
+                processes = min(processes, int(memory_limit // max(tile["peak_mb"], 1)))
+            if processes < 1:
+                continue
+            estimate = self.estimate_tiled(features, tiles_per_side, processes)
+            if runtime_limit is None or estimate["wall_s"] <= runtime_limit:
+                return tiles_per_side, processes
+        return None
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import os
+
+from qgis.core import (
+    QgsCoordinateTransformContext,
+    QgsProcessingException,
+    QgsVectorFileWriter,
+    QgsVectorLayer
+)
+
+from .sdna_plugin_tiling import WRITE_CHUNK_SIZE
+
+# Name shown to users, OGR driver and file extension of each format line outputs can be written in.
+# sDNA itself always writes shapefiles, which are transcoded to any other format afterwards.
+OUTPUT_FORMATS = [
+    ("Shapefile", "ESRI Shapefile", "shp"),
+    ("GeoPackage", "GPKG", "gpkg"),
+    ("FlatGeobuf", "FlatGeobuf", "fgb")
+]
+
+
+def transcode(source_path, destination, driver_name, feedback):
+    """Copy the shapefile at source_path to destination in another format, with a spatial index.
+
+    Features are read and written WRITE_CHUNK_SIZE at a time, so memory use does not grow
+    with the size of the output. Any existing file at destination is replaced.
+    """
+    layer = QgsVectorLayer(source_path, "sdna_output", "ogr")
+    if not layer.isValid():
+        raise QgsProcessingException(f"Could not open sDNA output {source_path}")
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = driver_name
+    options.fileEncoding = "utf-8"
+    options.layerName = os.path.splitext(os.path.basename(destination))[0]
+    options.layerOptions = ["SPATIAL_INDEX=YES"]
+    options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteFile
+    writer = QgsVectorFileWriter.create(
+        destination, layer.fields(), layer.wkbType(), layer.crs(), QgsCoordinateTransformContext(), options
+    )
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise QgsProcessingException(f"Could not create {destination}: {writer.errorMessage()}")
+
+    total = max(1, layer.featureCount())
+    written = 0
+    chunk = []
+    for feature in layer.getFeatures():
+        chunk.append(feature)
+        if len(chunk) >= WRITE_CHUNK_SIZE:
+            if feedback.isCanceled():
+                del writer
+                raise QgsProcessingException(f"Writing {destination} was cancelled")
+            writer.addFeatures(chunk)
+            written += len(chunk)
+            chunk = []
+            feedback.setProgress(100 * written / total)
+    writer.addFeatures(chunk)
+    written += len(chunk)
+    # Deleting the writer flushes the features and builds the spatial index
+    del writer
+    feedback.setProgressText(f"Wrote {written} links to {destination}")
+    return written
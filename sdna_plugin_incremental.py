@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import csv
+import hashlib
+import json
+import os
+import shutil
+
+from qgis.core import (
+    QgsCoordinateTransformContext,
+    QgsFeature,
+    QgsFields,
+    QgsRectangle,
+    QgsSpatialIndex,
+    QgsVectorFileWriter,
+    QgsVectorLayer
+)
+
+from .sdna_plugin_cache import (
+    FolderCache,
+    hash_description,
+    shapefile_parts
+)
+from .sdna_plugin_tiling import WRITE_CHUNK_SIZE
+from .sdna_plugin_writeback import SOURCE_ID_FIELD
+
+MANIFEST_FILE = "manifest.json"
+FINGERPRINTS_FILE = "fingerprints.csv"
+# Rerunning more than this fraction of the network is no quicker than running all of it
+FULL_RUN_FRACTION = 0.5
+
+
+def feature_fingerprint(feature, attribute_indexes):
+    """Return a short hash of a feature's geometry and the attributes at attribute_indexes."""
+    fingerprint = hashlib.blake2b(digest_size=8)
+    if feature.hasGeometry():
+        fingerprint.update(bytes(feature.geometry().asWkb()))
+    attributes = feature.attributes()
+    fingerprint.update(repr([attributes[index] for index in attribute_indexes]).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+def layer_fingerprints(layer, options, feedback):
+    """Map the id of each feature of layer exported with options to its fingerprint and bounding box.
+
+    Only exported fields are fingerprinted, so results written back onto the layer are not
+    taken for edits.
+    """
+    attribute_indexes = options.exported_field_indexes(layer)
+    features = layer.getFeatures(options.feature_request(layer).setSubsetOfAttributes(attribute_indexes))
+    fingerprints = {}
+    for feature in features:
+        if feedback.isCanceled():
+            break
+        box = feature.geometry().boundingBox() if feature.hasGeometry() else QgsRectangle()
+        fingerprints[feature.id()] = (
+            feature_fingerprint(feature, attribute_indexes), (box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum())
+        )
+    return fingerprints
+
+
+def diff_fingerprints(previous, current):
+    """Match the unchanged features of current to those of previous.
+
+    Returns a map of current feature ids to the ids of identical previous features, and the
+    bounding boxes of every edit: features added or changed in current and features removed
+    or changed from previous.
+    """
+    previous_by_fingerprint = {}
+    for fid, (fingerprint, _) in previous.items():
+        previous_by_fingerprint.setdefault(fingerprint, []).append(fid)
+    matches = {}
+    edited = []
+    for fid, (fingerprint, box) in current.items():
+        candidates = previous_by_fingerprint.get(fingerprint)
+        if candidates:
+            matches[fid] = candidates.pop()
+        else:
+            edited.append(box)
+    for fids in previous_by_fingerprint.values():
+        edited += [previous[fid][1] for fid in fids]
+    return matches, edited
+
+
+def affected_features(current, edited, radius, margin, candidates=None):
+    """Return the ids of features whose results edits can change, and of those needed to compute them.
+
+    A link's results depend only on links within the radius of it, so those within the
+    radius of an edit are affected. Computing an affected link needs every link within the
+    margin of it, as for a tile. If candidates is given, only those links can be affected,
+    though any link can be needed.
+    """
+    index = QgsSpatialIndex()
+    for fid, (_, box) in current.items():
+        index.addFeature(fid, QgsRectangle(*box))
+    affected = set()
+    for box in edited:
+        affected.update(index.intersects(QgsRectangle(*box).buffered(radius)))
+    if candidates is not None:
+        affected.intersection_update(candidates)
+    needed = set(affected)
+    for fid in affected:
+        needed.update(index.intersects(QgsRectangle(*current[fid][1]).buffered(margin)))
+    return affected, needed
+
+
+def output_stamp(path):
+    """Return something that changes whenever the output shapefile at path is rewritten."""
+    return [[os.path.basename(part), os.stat(part).st_mtime_ns, os.stat(part).st_size] for part in shapefile_parts(path)]
+
+
+def merge_outputs(previous_output, partial_output, matches, affected, destination, scratch_path, crs, feedback):
+    """Write an output combining the rerun results of affected links with earlier results of the rest.
+
+    previous_output is the output being updated and partial_output, which may be None if no
+    links are affected, the output of the rerun. Source ids in the merged output refer to the
+    current input. It is written to scratch_path first, so destination may be previous_output.
+    previous_output may be in any format, but the merged output is always a shapefile.
+    """
+    previous = QgsVectorLayer(previous_output, "previous", "ogr")
+    partial = QgsVectorLayer(partial_output, "partial", "ogr") if partial_output else None
+    if not previous.isValid() or (partial is not None and not partial.isValid()):
+        feedback.reportError("Could not open the outputs to merge")
+        return False
+    # Key columns such as a GeoPackage's fid belong to the file, not the results
+    key_indexes = set(previous.primaryKeyAttributes())
+    fields = QgsFields()
+    for index, field in enumerate(previous.fields()):
+        if index not in key_indexes:
+            fields.append(field)
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = "ESRI Shapefile"
+    options.fileEncoding = "utf-8"
+    writer = QgsVectorFileWriter.create(
+        scratch_path, fields, previous.wkbType(), crs, QgsCoordinateTransformContext(), options
+    )
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        feedback.reportError(f"Could not create {scratch_path}: {writer.errorMessage()}")
+        return False
+
+    current_of_previous = {previous_fid: fid for fid, previous_fid in matches.items() if fid not in affected}
+    id_index = fields.lookupField(SOURCE_ID_FIELD)
+    chunk = []
+    kept = 0
+
+    def add(feature, source_indexes, source_id=None):
+        merged = QgsFeature(fields)
+        merged.setGeometry(feature.geometry())
+        attributes = feature.attributes()
+        for index, source_index in enumerate(source_indexes):
+            if source_index >= 0:
+                merged.setAttribute(index, attributes[source_index])
+        if source_id is not None:
+            merged.setAttribute(id_index, source_id)
+        chunk.append(merged)
+        if len(chunk) >= WRITE_CHUNK_SIZE:
+            writer.addFeatures(chunk)
+            chunk.clear()
+
+    previous_indexes = [previous.fields().lookupField(field.name()) for field in fields]
+    for feature in previous.getFeatures():
+        fid = current_of_previous.get(feature[SOURCE_ID_FIELD])
+        if fid is None:
+            continue
+        add(feature, previous_indexes, fid)
+        kept += 1
+    rerun = 0
+    if partial is not None:
+        partial_indexes = [partial.fields().lookupField(field.name()) for field in fields]
+        for feature in partial.getFeatures():
+            if feature[SOURCE_ID_FIELD] not in affected:
+                continue
+            add(feature, partial_indexes)
+            rerun += 1
+    writer.addFeatures(chunk)
+    # Deleting the writer flushes and closes the file
+    del writer
+
+    destination_root, _ = os.path.splitext(destination)
+    for part in shapefile_parts(scratch_path):
+        shutil.copyfile(part, destination_root + os.path.splitext(part)[1])
+    feedback.setProgressText(f"Merged {rerun} rerun links with {kept} unchanged links into {destination}")
+    return True
+
+
+class IncrementalStore(FolderCache):
+    """Records of the input behind each output, so the output can later be updated incrementally.
+
+    Each entry is keyed by the output's path and holds a fingerprint and bounding box of every
+    input feature, along with the settings of the run and a stamp of the output file so a
+    record is not used once the output has been replaced by other means.
+    """
+
+    FOLDER_SETTING = "SDNA_INCREMENTAL_FOLDER_SETTING"
+    MAX_SIZE_SETTING = "SDNA_INCREMENTAL_MAX_SIZE_SETTING"
+
+    @staticmethod
+    def key(output_path):
+        return hash_description(os.path.normcase(os.path.abspath(output_path)))
+
+    def save(self, output_path, settings, fingerprints):
+        key = IncrementalStore.key(output_path)
+        # An output's record is replaced each time it is rewritten
+        shutil.rmtree(os.path.join(self.folder, key), ignore_errors=True)
+
+        def populate(folder):
+            with open(os.path.join(folder, FINGERPRINTS_FILE), "w", newline="", encoding="utf-8") as fingerprints_file:
+                writer = csv.writer(fingerprints_file)
+                for fid, (fingerprint, box) in fingerprints.items():
+                    writer.writerow([fid, fingerprint, *box])
+            manifest = {"output": output_path, "stamp": output_stamp(output_path), "settings": settings}
+            with open(os.path.join(folder, MANIFEST_FILE), "w", encoding="utf-8") as manifest_file:
+                json.dump(manifest, manifest_file)
+            return True
+
+        return self.store(key, populate) is not None
+
+    def load(self, output_path):
+        """Return the settings and fingerprints recorded for output_path, or None if there is no valid record."""
+        entry = self.entry_folder(IncrementalStore.key(output_path))
+        if not entry:
+            return None
+        try:
+            with open(os.path.join(entry, MANIFEST_FILE), encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest["stamp"] != output_stamp(output_path):
+                return None
+            fingerprints = {}
+            with open(os.path.join(entry, FINGERPRINTS_FILE), newline="", encoding="utf-8") as fingerprints_file:
+                for fid, fingerprint, *box in csv.reader(fingerprints_file):
+                    fingerprints[int(fid)] = (fingerprint, tuple(float(value) for value in box))
+        except (OSError, ValueError, KeyError):
+            return None
+        return manifest["settings"], fingerprints
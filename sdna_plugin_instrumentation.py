@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import contextlib
+import ctypes
+import json
+import os
+import sys
+import threading
+import time
+
+from qgis.core import QgsMessageLog
+from processing.core.ProcessingConfig import ProcessingConfig
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MB = 1024 * 1024
+
+
+def process_rss(pid=None):
+    """Return the resident memory of process pid, or of this process, in bytes, or 0 if it cannot be found."""
+    pid = os.getpid() if pid is None else pid
+    if psutil:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return 0
+    if sys.platform == "win32":
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ("cb", ctypes.c_ulong),
+                ("PageFaultCount", ctypes.c_ulong),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t)
+            ]
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        # PROCESS_QUERY_LIMITED_INFORMATION | PROCESS_VM_READ
+        process = ctypes.windll.kernel32.OpenProcess(0x1000 | 0x0010, False, pid)
+        if not process:
+            return 0
+        try:
+            if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+                return counters.WorkingSetSize
+            return 0
+        finally:
+            ctypes.windll.kernel32.CloseHandle(process)
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+
+class PeakMemorySampler:
+    """Samples memory use in the background while a phase runs and records the peak.
+
+    processes, if given, returns the pids of the processes started for the phase, such as its
+    sDNA runs. Their combined memory is sampled alongside our own, while other processes we
+    started, like the persistent worker or other background jobs, are left out. Listing
+    processes is slower than reading their memory, so the list is refreshed less often.
+    """
+
+    def __init__(self, processes=None, interval=0.05, refresh_interval=1.0):
+        self.processes = processes
+        self.interval = interval
+        self.refresh_interval = refresh_interval
+        self.pids = []
+        self.next_refresh = 0
+        self.peak_rss = 0
+        self.peak_children_rss = 0
+        self.stop = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, process_rss())
+        if self.processes is None:
+            return
+        if time.monotonic() >= self.next_refresh:
+            self.pids = self.processes()
+            self.next_refresh = time.monotonic() + self.refresh_interval
+        self.peak_children_rss = max(self.peak_children_rss, sum(process_rss(pid) for pid in self.pids))
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        self.thread.join()
+        self.sample()
+
+
+class RunRecorder:
+    """Records how long each phase of a run takes and how much memory it uses.
+
+    When the run finishes a summary goes to the message log and, if a run log file is set in
+    the provider settings, a JSON record of the run is appended to it as one line.
+    """
+
+    LOG_FILE_SETTING = "SDNA_RUN_LOG_FILE_SETTING"
+
+    def __init__(self, algorithm_name):
+        self.algorithm_name = algorithm_name
+        self.started = time.time()
+        self.phases = []
+        self.record = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, processes=None):
+        """Record the time and memory taken by the body, and by the processes it starts if given.
+
+        processes is as for PeakMemorySampler.
+        """
+        started = time.perf_counter()
+        with PeakMemorySampler(processes) as sampler:
+            yield
+        phase = {
+            "name": name,
+            "wall_s": round(time.perf_counter() - started, 3),
+            "peak_rss_mb": round(sampler.peak_rss / MB, 1)
+        }
+        if sampler.peak_children_rss:
+            phase["children_peak_rss_mb"] = round(sampler.peak_children_rss / MB, 1)
+        with self.lock:
+            self.phases.append(phase)
+
+    def add(self, **values):
+        """Add values such as input feature counts or the sDNA syntax to the run's record."""
+        with self.lock:
+            self.record.update(values)
+
+    def finish(self, retval):
+        total = time.time() - self.started
+        record = {
+            "algorithm": self.algorithm_name,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "total_s": round(total, 3),
+            "retval": retval,
+            "phases": self.phases
+        }
+        record.update(self.record)
+
+        lines = [f"{self.algorithm_name} finished in {total:.1f}s"]
+        for phase in self.phases:
+            line = f"    {phase['name']}: {phase['wall_s']:.1f}s, peak {phase['peak_rss_mb']:.0f} MB"
+            if "children_peak_rss_mb" in phase:
+                line += f" (sDNA {phase['children_peak_rss_mb']:.0f} MB)"
+            lines.append(line)
+        QgsMessageLog.logMessage("\n".join(lines), "sDNA")
+
+        log_file = ProcessingConfig.getSetting(RunRecorder.LOG_FILE_SETTING)
+        if log_file:
+            try:
+                with open(log_file, "a", encoding="utf-8") as log:
+                    log.write(json.dumps(record, default=str) + "\n")
+            except OSError as e:
+                QgsMessageLog.logMessage(f"Could not write run record to {log_file}: {e}", "sDNA")
+        return record
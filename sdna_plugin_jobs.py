@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import heapq
+import itertools
+import os
+
+from qgis.PyQt.QtCore import (
+    QObject,
+    pyqtSignal
+)
+from qgis.core import (
+    QgsApplication,
+    QgsMessageLog,
+    QgsProcessingAlgRunnerTask,
+    QgsProcessingContext,
+    QgsProcessingFeedback,
+    QgsProject,
+    QgsVectorLayer
+)
+from processing.core.ProcessingConfig import ProcessingConfig
+
+from .sdna_plugin_formats import OUTPUT_FORMATS
+
+
+class SDNAJob:
+    """One queued run of an sDNA algorithm."""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, job_id, algorithm_id, parameters, priority, description, outputs):
+        self.job_id = job_id
+        self.algorithm_id = algorithm_id
+        self.parameters = parameters
+        self.priority = priority
+        self.description = description
+        self.outputs = outputs
+        self.status = SDNAJob.QUEUED
+        self.task = None
+        self.context = None
+        self.feedback = None
+        self.results = None
+
+
+class SDNAJobQueue(QObject):
+    """Runs sDNA algorithms as QGIS background tasks, a limited number at a time.
+
+    Jobs wait in priority order, highest first and then in order of submission. Output
+    layers are added to the project as each job completes. Cancelling a running job cancels
+    its feedback, which terminates its sDNA process.
+
+    submit may be called from any thread; the queue itself lives in the main thread.
+    """
+
+    MAX_JOBS_SETTING = "SDNA_MAX_BACKGROUND_JOBS_SETTING"
+
+    submitRequested = pyqtSignal(object)
+    jobChanged = pyqtSignal(object)
+
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        self.jobs = {}
+        self.waiting = []
+        self.job_ids = itertools.count(1)
+        self.submitRequested.connect(self.enqueue)
+
+    @staticmethod
+    def max_jobs():
+        return max(1, int(ProcessingConfig.getSetting(SDNAJobQueue.MAX_JOBS_SETTING) or 1))
+
+    def submit(self, algorithm_id, parameters, priority=0, description=None, outputs=None):
+        """Queue a run of the algorithm with the given parameters and return its job id.
+
+        outputs lists the layer files the job writes, which are added to the project when it finishes.
+        """
+        job = SDNAJob(
+            next(self.job_ids), algorithm_id, dict(parameters), priority, description or algorithm_id, outputs or []
+        )
+        self.jobs[job.job_id] = job
+        # Emitting rather than calling hands the job to the main thread if we are in a worker thread
+        self.submitRequested.emit(job)
+        return job.job_id
+
+    def enqueue(self, job):
+        heapq.heappush(self.waiting, (-job.priority, job.job_id, job))
+        QgsMessageLog.logMessage(f"Queued sDNA job {job.job_id}: {job.description} (priority {job.priority})", "sDNA")
+        self.jobChanged.emit(job)
+        self.start_waiting_jobs()
+
+    def running_jobs(self):
+        # A cancelled job still counts until its task has wound down
+        return [job for job in self.jobs.values() if job.task is not None]
+
+    def start_waiting_jobs(self):
+        while self.waiting and len(self.running_jobs()) < self.max_jobs():
+            _, _, job = heapq.heappop(self.waiting)
+            if job.status == SDNAJob.QUEUED:
+                self.start(job)
+
+    def start(self, job):
+        algorithm = QgsApplication.processingRegistry().createAlgorithmById(job.algorithm_id)
+        if algorithm is None:
+            job.status = SDNAJob.FAILED
+            QgsMessageLog.logMessage(f"sDNA job {job.job_id}: no algorithm {job.algorithm_id}", "sDNA")
+            self.jobChanged.emit(job)
+            return
+        job.context = QgsProcessingContext()
+        job.context.setProject(QgsProject.instance())
+        job.feedback = QgsProcessingFeedback()
+        job.task = QgsProcessingAlgRunnerTask(algorithm, job.parameters, job.context, job.feedback)
+        job.task.executed.connect(lambda successful, results, job=job: self.finished(job, successful, results))
+        job.status = SDNAJob.RUNNING
+        QgsMessageLog.logMessage(f"Started sDNA job {job.job_id}: {job.description}", "sDNA")
+        self.jobChanged.emit(job)
+        QgsApplication.taskManager().addTask(job.task)
+
+    def finished(self, job, successful, results):
+        if job.status != SDNAJob.CANCELLED:
+            job.status = SDNAJob.FINISHED if successful else SDNAJob.FAILED
+        if job.status == SDNAJob.FINISHED:
+            job.results = results
+            self.add_output_layers(job)
+        QgsMessageLog.logMessage(f"sDNA job {job.job_id} {job.status}: {job.description}", "sDNA")
+        job.task = None
+        self.jobChanged.emit(job)
+        self.start_waiting_jobs()
+
+    def add_output_layers(self, job):
+        paths = list(job.outputs)
+        paths += [value for value in job.results.values() if isinstance(value, str) and value not in paths]
+        # Line outputs can be in any of the output formats
+        extensions = tuple(f".{extension}" for _, _, extension in OUTPUT_FORMATS)
+        for path in paths:
+            if path.lower().endswith(extensions) and os.path.isfile(path):
+                layer = QgsVectorLayer(path, f"{job.description} ({os.path.basename(path)})", "ogr")
+                if layer.isValid():
+                    QgsProject.instance().addMapLayer(layer)
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job. Returns False if the job has already ended."""
+        job = self.jobs.get(job_id)
+        if job is None or job.status not in [SDNAJob.QUEUED, SDNAJob.RUNNING]:
+            return False
+        was_running = job.status == SDNAJob.RUNNING
+        job.status = SDNAJob.CANCELLED
+        if was_running:
+            job.feedback.cancel()
+            job.task.cancel()
+        QgsMessageLog.logMessage(f"Cancelled sDNA job {job.job_id}: {job.description}", "sDNA")
+        self.jobChanged.emit(job)
+        return True
+
+    def cancel_all(self):
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Binary matrices converted from sDNA's skim matrix and OD table CSV outputs.
+
+ A matrix is stored as two files. <name>.bin holds 8 byte floats in origin, destination,
+ value order, so each origin's row is contiguous and can be read on its own through a
+ memory map. <name>.json is the index, giving the origin and destination names, the names
+ of the values and the byte order. Missing values are NaN.
+
+ With numpy the data can be opened as
+     numpy.memmap(bin_path, dtype=index["dtype"], mode="r", shape=index["shape"])
+ and MatrixReader does the same without it. This module does not import QGIS, so scripts
+ outside QGIS can use it to read matrices.
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import array
+import csv
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+
+MATRIX_FORMAT = "sdna-matrix"
+MATRIX_VERSION = 1
+VALUE_SIZE = 8
+FILL_CHUNK = 1024 * 1024
+PROGRESS_ROWS = 10000
+
+
+def matrix_paths(csv_path):
+    """Return the index and data paths of the matrix converted from csv_path."""
+    root, _ = os.path.splitext(csv_path)
+    return f"{root}.json", f"{root}.bin"
+
+
+def to_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return math.nan
+
+
+def read_csv(path, feedback):
+    """Yield the rows of the CSV file at path, reporting how much has been read to feedback."""
+    size = max(1, os.path.getsize(path))
+    with open(path, "rb") as csv_file:
+        lines = (line.decode("utf-8-sig") for line in csv_file)
+        for count, row in enumerate(csv.reader(lines)):
+            if count % PROGRESS_ROWS == 0:
+                if feedback.isCanceled():
+                    raise InterruptedError("Matrix conversion cancelled")
+                feedback.setProgress(100 * csv_file.tell() / size)
+            if row:
+                yield row
+
+
+def is_long_format(header):
+    """Whether a CSV has one origin, destination pair per row rather than one origin per row."""
+    return len(header) >= 3 and "orig" in header[0].lower() and "dest" in header[1].lower()
+
+
+def write_wide(rows, header, data_file):
+    """Write rows of an origin followed by a value for each destination, returning the index."""
+    destinations = header[1:]
+    origins = []
+    for row in rows:
+        origins.append(row[0])
+        values = array.array("d", (to_float(value) for value in row[1:len(destinations) + 1]))
+        values.extend([math.nan] * (len(destinations) - len(values)))
+        data_file.write(values.tobytes())
+    return origins, destinations, ["value"]
+
+
+def write_long(path, header, data_file, feedback):
+    """Write rows of an origin, a destination and its values, returning the index.
+
+    The origins and destinations are found in a first pass over the file and values are put
+    in place through a memory map in a second, so rows may come in any order.
+    """
+    value_names = header[2:]
+    origins, destinations = {}, {}
+    rows = read_csv(path, feedback)
+    next(rows)
+    for row in rows:
+        origins.setdefault(row[0], len(origins))
+        destinations.setdefault(row[1], len(destinations))
+
+    row_values = len(destinations) * len(value_names)
+    size = len(origins) * row_values * VALUE_SIZE
+    nan_chunk = (array.array("d", [math.nan]) * (FILL_CHUNK // VALUE_SIZE)).tobytes()
+    remaining = size
+    while remaining > 0:
+        data_file.write(nan_chunk[:remaining])
+        remaining -= FILL_CHUNK
+    data_file.flush()
+
+    if size:
+        packer = struct.Struct(f"={len(value_names)}d")
+        with mmap.mmap(data_file.fileno(), size) as data:
+            rows = read_csv(path, feedback)
+            next(rows)
+            for row in rows:
+                offset = (origins[row[0]] * row_values + destinations[row[1]] * len(value_names)) * VALUE_SIZE
+                values = [to_float(value) for value in row[2:len(value_names) + 2]]
+                values.extend([math.nan] * (len(value_names) - len(values)))
+                packer.pack_into(data, offset, *values)
+    return list(origins), list(destinations), value_names
+
+
+def convert_csv_to_matrix(csv_path, feedback):
+    """Convert a skim matrix or OD table CSV to a binary matrix and return the path of its index.
+
+    Tables with origin and destination columns followed by value columns are read as one
+    row per pair; anything else as a grid with destinations across and origins down.
+    """
+    index_path, data_path = matrix_paths(csv_path)
+    try:
+        rows = read_csv(csv_path, feedback)
+        header = next(rows, None)
+        if header is None:
+            raise ValueError(f"{csv_path} is empty")
+        with open(data_path, "wb+") as data_file:
+            if is_long_format(header):
+                rows.close()
+                origins, destinations, value_names = write_long(csv_path, header, data_file, feedback)
+            else:
+                origins, destinations, value_names = write_wide(rows, header, data_file)
+    except BaseException:
+        for path in [index_path, data_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    index = {
+        "format": MATRIX_FORMAT,
+        "version": MATRIX_VERSION,
+        "source": os.path.basename(csv_path),
+        "data": os.path.basename(data_path),
+        "dtype": ("<" if sys.byteorder == "little" else ">") + "f8",
+        "shape": [len(origins), len(destinations), len(value_names)],
+        "origins": origins,
+        "destinations": destinations,
+        "values": value_names
+    }
+    with open(index_path, "w", encoding="utf-8") as index_file:
+        json.dump(index, index_file)
+    feedback.setProgress(100)
+    return index_path
+
+
+class MatrixReader:
+    """Reads rows and cells of a binary matrix through a memory map, without loading all of it."""
+
+    def __init__(self, index_path):
+        with open(index_path, encoding="utf-8") as index_file:
+            self.index = json.load(index_file)
+        if self.index.get("format") != MATRIX_FORMAT:
+            raise ValueError(f"{index_path} is not an sDNA matrix index")
+        self.data_path = os.path.join(os.path.dirname(index_path), self.index["data"])
+        self.origins = {name: i for i, name in enumerate(self.index["origins"])}
+        self.destinations = {name: i for i, name in enumerate(self.index["destinations"])}
+        self.value_names = self.index["values"]
+        self.swap_bytes = (self.index["dtype"][0] == "<") != (sys.byteorder == "little")
+        self.data_file = open(self.data_path, "rb")
+        size = os.path.getsize(self.data_path)
+        self.data = mmap.mmap(self.data_file.fileno(), size, access=mmap.ACCESS_READ) if size else b""
+
+    def value_index(self, value):
+        return self.value_names.index(value) if isinstance(value, str) else value
+
+    def row(self, origin, value=0):
+        """Return the named or numbered value from origin to every destination, in the index's order."""
+        value_count = len(self.value_names)
+        row_size = len(self.destinations) * value_count * VALUE_SIZE
+        start = self.origins[origin] * row_size
+        values = array.array("d")
+        values.frombytes(self.data[start:start + row_size])
+        if self.swap_bytes:
+            values.byteswap()
+        return list(values[self.value_index(value)::value_count])
+
+    def get(self, origin, destination, value=0):
+        value_count = len(self.value_names)
+        cell = (self.origins[origin] * len(self.destinations) + self.destinations[destination]) * value_count
+        offset = (cell + self.value_index(value)) * VALUE_SIZE
+        return struct.unpack_from(self.index["dtype"][0] + "d", self.data, offset)[0]
+
+    def as_array(self):
+        """Return the whole matrix as a read only numpy memmap of shape (origins, destinations, values)."""
+        import numpy
+        return numpy.memmap(self.data_path, dtype=self.index["dtype"], mode="r", shape=tuple(self.index["shape"]))
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
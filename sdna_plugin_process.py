@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from qgis.core import QgsMessageLog
+from processing.core.ProcessingConfig import ProcessingConfig
+
+from .sdna_plugin_costmodel import (
+    CostModel,
+    format_duration
+)
+from .sdna_plugin_instrumentation import (
+    MB,
+    process_rss
+)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Checking limits means listing every process, so is done less often than checking for cancel
+LIMIT_CHECK_INTERVAL = 2.0
+
+
+def process_table():
+    """Return a list of (pid, parent pid, command line) for every process visible to us."""
+    if psutil:
+        table = []
+        for process in psutil.process_iter(["pid", "ppid", "cmdline"]):
+            cmdline = process.info["cmdline"] or []
+            table.append((process.info["pid"], process.info["ppid"], " ".join(cmdline)))
+        return table
+    if sys.platform == "win32":
+        output = subprocess.run(
+            [
+                "powershell", "-NoProfile", "-Command",
+                "Get-CimInstance Win32_Process | Select-Object ProcessId,ParentProcessId,CommandLine | ConvertTo-Json"
+            ],
+            capture_output=True, text=True, creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0)
+        ).stdout
+        try:
+            rows = json.loads(output or "[]")
+        except ValueError:
+            return []
+        return [(row["ProcessId"], row["ParentProcessId"], row["CommandLine"] or "") for row in rows]
+    try:
+        names = os.listdir("/proc")
+    except OSError:
+        # No /proc, as on macOS, and no psutil to list processes another way
+        return []
+    table = []
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as stat:
+                # The command name in brackets may contain spaces, so split after it
+                ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{name}/cmdline", "rb") as cmdline:
+                command = cmdline.read().replace(b"\0", b" ").decode("utf-8", "replace")
+        except (OSError, ValueError, IndexError):
+            continue
+        table.append((int(name), ppid, command))
+    return table
+
+
+def descendants(pid, table=None):
+    """Return the (pid, command line) of every descendant of pid, children before grandchildren."""
+    table = process_table() if table is None else table
+    children = {}
+    for child_pid, parent_pid, command in table:
+        children.setdefault(parent_pid, []).append((child_pid, command))
+    found = []
+    pending = [pid]
+    while pending:
+        for child in children.get(pending.pop(0), []):
+            found.append(child)
+            pending.append(child[0])
+    return found
+
+
+def find_sdna_processes(marker):
+    """Return the pids of our descendant processes whose command line contains marker.
+
+    runsdnacommand does not hand back the process it starts, so sDNA processes are found by
+    something unique to their run, such as an output path, in their command line.
+    """
+    return [pid for pid, command in descendants(os.getpid()) if marker and marker in command]
+
+
+def run_processes(markers):
+    """Return the pids of our processes for the runs with markers, along with all their descendants."""
+    table = process_table()
+    pids = []
+    for pid, command in descendants(os.getpid(), table):
+        if any(marker and marker in command for marker in markers):
+            pids.append(pid)
+            pids += [child_pid for child_pid, _ in descendants(pid, table)]
+    return list(dict.fromkeys(pids))
+
+
+def terminate_process_tree(pid, grace=3.0):
+    """Terminate pid and all its descendants, killing any that do not exit within grace seconds."""
+    if psutil:
+        try:
+            root = psutil.Process(pid)
+            processes = root.children(recursive=True) + [root]
+        except psutil.Error:
+            return
+        for process in processes:
+            try:
+                process.terminate()
+            except psutil.Error:
+                pass
+        _, alive = psutil.wait_procs(processes, timeout=grace)
+        for process in alive:
+            try:
+                process.kill()
+            except psutil.Error:
+                pass
+        return
+    if sys.platform == "win32":
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(pid)],
+            capture_output=True, creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0)
+        )
+        return
+    pids = [child_pid for child_pid, _ in reversed(descendants(pid))] + [pid]
+    for target in pids:
+        try:
+            os.kill(target, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.monotonic() + grace
+    while time.monotonic() < deadline and any(os.path.exists(f"/proc/{target}") for target in pids):
+        time.sleep(0.1)
+    for target in pids:
+        try:
+            os.kill(target, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def set_cpu_affinity(pid, cpus):
+    """Restrict pid to the given CPU cores, returning whether that was possible."""
+    if psutil and hasattr(psutil.Process, "cpu_affinity"):
+        try:
+            psutil.Process(pid).cpu_affinity(cpus)
+            return True
+        except (psutil.Error, ValueError):
+            return False
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(pid, cpus)
+            return True
+        except (OSError, ValueError):
+            return False
+    return False
+
+
+def parse_cpu_list(text):
+    """Parse CPU cores given as e.g. "0-3,6" into a sorted list of core numbers."""
+    cpus = set()
+    for part in str(text).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+class ResourceLimits:
+    """Limits on the wall-clock time, memory and CPU cores of one run's sDNA processes.
+
+    The runtime and memory limits are those the cost model warns about. One instance is
+    shared by the watchdogs of every sDNA process in a run, so the memory limit applies to
+    their total and the first limit exceeded stops them all.
+    """
+
+    CPU_AFFINITY_SETTING = "SDNA_CPU_AFFINITY_SETTING"
+
+    def __init__(self, runtime_s=None, memory_mb=None, cpus=None):
+        self.runtime_s = runtime_s
+        self.deadline = time.monotonic() + runtime_s if runtime_s else None
+        self.memory_mb = memory_mb
+        self.cpus = cpus
+        # Memory in use by each watched run, keyed by its marker
+        self.memory = {}
+        self.exceeded = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_settings():
+        runtime_minutes = float(ProcessingConfig.getSetting(CostModel.RUNTIME_LIMIT_SETTING) or 0)
+        memory_mb = float(ProcessingConfig.getSetting(CostModel.MEMORY_LIMIT_SETTING) or 0)
+        try:
+            cpus = parse_cpu_list(ProcessingConfig.getSetting(ResourceLimits.CPU_AFFINITY_SETTING) or "")
+        except ValueError:
+            QgsMessageLog.logMessage("Ignoring CPU cores setting, which should look like 0-3,6", "sDNA")
+            cpus = []
+        return ResourceLimits(runtime_minutes * 60 or None, memory_mb or None, cpus or None)
+
+    def is_active(self):
+        return bool(self.deadline or self.memory_mb or self.cpus)
+
+    def check(self, marker, pids, table):
+        """Return why the run must stop, given the pids of one of its sDNA processes, or None."""
+        if self.exceeded is None and self.deadline and time.monotonic() > self.deadline:
+            self.stop(f"exceeded the runtime limit of {format_duration(self.runtime_s)}")
+        if self.exceeded is None and self.memory_mb:
+            tree = set(pids)
+            for pid in pids:
+                tree.update(child_pid for child_pid, _ in descendants(pid, table))
+            with self.lock:
+                self.memory[marker] = sum(process_rss(pid) for pid in tree)
+                total = sum(self.memory.values())
+            if total > self.memory_mb * MB:
+                self.stop(f"exceeded the memory limit of {self.memory_mb:.0f} MB")
+        return self.exceeded
+
+    def stop(self, reason):
+        with self.lock:
+            if self.exceeded is None:
+                self.exceeded = reason
+
+
+def run_marker(syntax):
+    """Return something in the command line of the run of syntax that no other run shares."""
+    for path in syntax["outputs"].values():
+        if path:
+            return path.rstrip("\\")
+    return None
+
+
+class SDNAProcessWatchdog:
+    """Watches a run's feedback in the background and terminates its sDNA processes on cancel.
+
+    Given resource limits, it also pins the processes to the allowed CPU cores and terminates
+    them once the run exceeds its runtime or memory limit.
+    """
+
+    def __init__(self, feedback, syntax, limits=None, interval=0.5):
+        self.feedback = feedback
+        self.marker = run_marker(syntax)
+        self.limits = limits if limits is not None and limits.is_active() else None
+        self.interval = interval
+        self.stop = threading.Event()
+        self.thread = None
+        self.cancelled = False
+        self.pinned = set()
+
+    def watch(self):
+        next_check = 0
+        while not self.stop.wait(self.interval):
+            if self.feedback.isCanceled():
+                self.terminate("cancelled")
+                return
+            if self.limits is None or time.monotonic() < next_check:
+                continue
+            next_check = time.monotonic() + LIMIT_CHECK_INTERVAL
+            table = process_table()
+            pids = [pid for pid, command in descendants(os.getpid(), table) if self.marker in command]
+            if self.limits.cpus:
+                self.pin(pids, table)
+            reason = self.limits.check(self.marker, pids, table)
+            if reason:
+                self.terminate(reason)
+                return
+
+    def pin(self, pids, table):
+        """Restrict sDNA processes not yet pinned, and their children, to the allowed CPU cores."""
+        for pid in pids:
+            for target in [pid] + [child_pid for child_pid, _ in descendants(pid, table)]:
+                if target not in self.pinned and set_cpu_affinity(target, self.limits.cpus):
+                    self.pinned.add(target)
+
+    def terminate(self, reason):
+        self.cancelled = True
+        pids = find_sdna_processes(self.marker)
+        for pid in pids:
+            terminate_process_tree(pid)
+        QgsMessageLog.logMessage(f"Run {reason}: terminated {len(pids)} sDNA processes", "sDNA")
+
+    def __enter__(self):
+        if self.marker:
+            self.thread = threading.Thread(target=self.watch, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        if self.thread:
+            self.thread.join()
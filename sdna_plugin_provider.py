@@ -21,7 +21,9 @@ __revision__ = "$Format:%H$"
 
 import os
 import sys
+import time
 
+import qgis.utils
 from PyQt5.QtWidgets import (
     QDialog,
     QMessageBox
@@ -35,7 +37,26 @@ from processing.core.ProcessingConfig import (
     Setting,
     ProcessingConfig
 )
-from .sdna_plugin_algorithm import SDNAAlgorithm
+from .sdna_plugin_algorithm import (
+    ProgressAdaptor,
+    SDNAAlgorithm
+)
+from .sdna_plugin_cache import (
+    ConversionCache,
+    RunCache
+)
+from .sdna_plugin_costmodel import CostModel
+from .sdna_plugin_incremental import IncrementalStore
+from .sdna_plugin_instrumentation import RunRecorder
+from .sdna_plugin_jobs import SDNAJobQueue
+from .sdna_plugin_process import ResourceLimits
+from .sdna_plugin_scratch import ScratchSpace
+from .sdna_plugin_specs import (
+    LazySDNACommand,
+    SpecCache
+)
+from .sdna_plugin_sweep import SDNASweepAlgorithm
+from .sdna_plugin_worker import SDNAWorker
 
 
 class SDNAPluginProvider(QgsProcessingProvider):
@@ -44,11 +65,13 @@ class SDNAPluginProvider(QgsProcessingProvider):
 
     def __init__(self):
         self.sdna_path = None
-        self.run_sdna_command = None
-        self.sdna_algorithm_spec_classes = None
+        # sDNA's own modules are only imported when first needed; see loadAlgorithms
+        self.run_sdna_command = LazySDNACommand()
+        self.spec_cache = SpecCache()
         QgsProcessingProvider.__init__(self)
+        self.job_queue = SDNAJobQueue()
+        self.sdna_worker = None
         self.configure_settings()
-        self.import_sdna_library()
 
     def configure_settings(self):
         ProcessingConfig.addSetting(Setting(
@@ -58,45 +81,218 @@ class SDNAPluginProvider(QgsProcessingProvider):
             "c:\\Program Files (x86)\\sDNA",
             valuetype=Setting.FOLDER
         ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            ConversionCache.FOLDER_SETTING,
+            self.tr("Converted input cache folder (leave empty to disable)"),
+            "",
+            valuetype=Setting.FOLDER
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            ConversionCache.MAX_SIZE_SETTING,
+            self.tr("Converted input cache size limit (MB)"),
+            4096,
+            valuetype=Setting.INT
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            RunCache.FOLDER_SETTING,
+            self.tr("Run results cache folder (leave empty to disable)"),
+            "",
+            valuetype=Setting.FOLDER
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            RunCache.MAX_SIZE_SETTING,
+            self.tr("Run results cache size limit (MB)"),
+            8192,
+            valuetype=Setting.INT
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            ProgressAdaptor.INTERVAL_SETTING,
+            self.tr("Minimum interval between sDNA progress updates (ms)"),
+            500,
+            valuetype=Setting.INT
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            ProgressAdaptor.LOG_FOLDER_SETTING,
+            self.tr("Folder to write full sDNA logs to (leave empty to disable)"),
+            "",
+            valuetype=Setting.FOLDER
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            RunRecorder.LOG_FILE_SETTING,
+            self.tr("File to append a JSON record of each run to (leave empty to disable)"),
+            "",
+            valuetype=Setting.FILE
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            SDNAJobQueue.MAX_JOBS_SETTING,
+            self.tr("Maximum number of background jobs running at once"),
+            2,
+            valuetype=Setting.INT
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            SDNAWorker.ENABLED_SETTING,
+            self.tr("Keep a persistent sDNA worker process running for faster small runs"),
+            False
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            ScratchSpace.FOLDER_SETTING,
+            self.tr("Scratch folder for temporary files, e.g. on a RAM disk (leave empty to use the system temporary folder)"),
+            "",
+            valuetype=Setting.FOLDER
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            ScratchSpace.MAX_SIZE_SETTING,
+            self.tr("Scratch folder size limit (MB)"),
+            1024,
+            valuetype=Setting.INT
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            IncrementalStore.FOLDER_SETTING,
+            self.tr("Folder for incremental re-analysis records (needed to record runs for later update)"),
+            "",
+            valuetype=Setting.FOLDER
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            IncrementalStore.MAX_SIZE_SETTING,
+            self.tr("Incremental re-analysis records size limit (MB)"),
+            2048,
+            valuetype=Setting.INT
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            CostModel.RUNTIME_LIMIT_SETTING,
+            self.tr("sDNA runtime limit; longer runs are stopped (minutes, 0 for none)"),
+            0,
+            valuetype=Setting.INT
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            CostModel.MEMORY_LIMIT_SETTING,
+            self.tr("sDNA memory limit; runs using more are stopped (MB, 0 to only warn about runs needing more than is available)"),
+            0,
+            valuetype=Setting.INT
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            CostModel.REFUSE_SETTING,
+            self.tr("Refuse runs estimated to exceed the runtime or memory limit, rather than warning"),
+            False
+        ))
+        ProcessingConfig.addSetting(Setting(
+            self.longName(),
+            ResourceLimits.CPU_AFFINITY_SETTING,
+            self.tr("CPU cores sDNA may use, e.g. 0-3,6 (leave empty for all)"),
+            ""
+        ))
         ProcessingConfig.readSettings()
 
-    def import_sdna_library(self):
+    def locate_sdna_library(self):
         sdna_root_dir = ProcessingConfig.getSetting(SDNAPluginProvider.SDNA_FOLDER_SETTING)
         self.sdna_path = '"' + os.path.join(sdna_root_dir, "bin") + '"'
         QgsMessageLog.logMessage(f"sDNA root: {sdna_root_dir}", "sDNA")
         if sdna_root_dir not in sys.path:
             sys.path.insert(0, sdna_root_dir)
+        return sdna_root_dir
+
+    def import_sdna_library(self):
+        """Import sDNA's tool specifications, returning an instance of each tool or None on failure."""
         try:
             import sDNAUISpec
-            import runsdnacommand
-            self.sdna_algorithm_spec_classes = sDNAUISpec.get_tools()
-            self.run_sdna_command = runsdnacommand.runsdnacommand
+            sdna_algorithm_specs = [spec_class() for spec_class in sDNAUISpec.get_tools()]
             QgsMessageLog.logMessage("Successfully imported sDNA modules", "sDNA")
+            return sdna_algorithm_specs
         except ImportError as e:
             QgsMessageLog.logMessage(str(e), "sDNA")
             self.show_install_sdna_message()
+            return None
 
     def show_install_sdna_message(self):
-        QMessageBox.critical(
-            QDialog(),
-            "sDNA: Error",
-            (
-                "Please ensure sDNA version 3.0 or later is installed ensure "
-                "the sDNA installation folder is set correctly in"
-                f"Processing -> Options -> Providers -> {self.longName()}"
-            )
+        message = (
+            "Please ensure sDNA version 3.0 or later is installed ensure "
+            "the sDNA installation folder is set correctly in"
+            f"Processing -> Options -> Providers -> {self.longName()}"
         )
+        # Headless runs, such as sdna_batch.py or qgis_process, have no window to show a dialog in
+        if qgis.utils.iface is None:
+            QgsMessageLog.logMessage(message, "sDNA")
+            return
+        QMessageBox.critical(QDialog(), "sDNA: Error", message)
+
+    def get_sdna_worker(self):
+        """Return the persistent sDNA worker, creating it on first use, or None if it is disabled."""
+        if not SDNAWorker.enabled():
+            if self.sdna_worker:
+                self.sdna_worker.stop()
+                self.sdna_worker = None
+            return None
+        if self.sdna_worker is None:
+            self.sdna_worker = SDNAWorker()
+        return self.sdna_worker
 
     def unload(self):
+        self.job_queue.cancel_all()
+        if self.sdna_worker:
+            self.sdna_worker.stop()
+        ScratchSpace.remove_session_outputs()
         ProcessingConfig.removeSetting(SDNAPluginProvider.SDNA_FOLDER_SETTING)
+        ProcessingConfig.removeSetting(ConversionCache.FOLDER_SETTING)
+        ProcessingConfig.removeSetting(ConversionCache.MAX_SIZE_SETTING)
+        ProcessingConfig.removeSetting(RunCache.FOLDER_SETTING)
+        ProcessingConfig.removeSetting(RunCache.MAX_SIZE_SETTING)
+        ProcessingConfig.removeSetting(ProgressAdaptor.INTERVAL_SETTING)
+        ProcessingConfig.removeSetting(ProgressAdaptor.LOG_FOLDER_SETTING)
+        ProcessingConfig.removeSetting(RunRecorder.LOG_FILE_SETTING)
+        ProcessingConfig.removeSetting(SDNAJobQueue.MAX_JOBS_SETTING)
+        ProcessingConfig.removeSetting(SDNAWorker.ENABLED_SETTING)
+        ProcessingConfig.removeSetting(ScratchSpace.FOLDER_SETTING)
+        ProcessingConfig.removeSetting(ScratchSpace.MAX_SIZE_SETTING)
+        ProcessingConfig.removeSetting(IncrementalStore.FOLDER_SETTING)
+        ProcessingConfig.removeSetting(IncrementalStore.MAX_SIZE_SETTING)
+        ProcessingConfig.removeSetting(CostModel.RUNTIME_LIMIT_SETTING)
+        ProcessingConfig.removeSetting(CostModel.MEMORY_LIMIT_SETTING)
+        ProcessingConfig.removeSetting(CostModel.REFUSE_SETTING)
+        ProcessingConfig.removeSetting(ResourceLimits.CPU_AFFINITY_SETTING)
 
     def loadAlgorithms(self):
-        """Load all of the algorithms belonging to this provider."""
-        if self.sdna_algorithm_spec_classes:
-            for sdna_algorithm_spec_class in self.sdna_algorithm_spec_classes:
-                sdna_algorithm_spec = sdna_algorithm_spec_class()
-                sdna_algorithm = SDNAAlgorithm(sdna_algorithm_spec, self.sdna_path, self.run_sdna_command)
-                self.addAlgorithm(sdna_algorithm)
+        """Load all of the algorithms belonging to this provider.
+
+        Tools are registered from descriptions cached on an earlier startup where possible,
+        so sDNA itself is not imported until an algorithm actually runs.
+        """
+        started = time.perf_counter()
+        sdna_root_dir = self.locate_sdna_library()
+        sdna_algorithm_specs = self.spec_cache.load(sdna_root_dir, self.sdna_path)
+        cache_status = "cached"
+        if sdna_algorithm_specs is None:
+            cache_status = "imported"
+            sdna_algorithm_specs = self.import_sdna_library()
+            if not sdna_algorithm_specs:
+                return
+            self.spec_cache.save(sdna_root_dir, self.sdna_path, sdna_algorithm_specs)
+
+        for sdna_algorithm_spec in sdna_algorithm_specs:
+            sdna_algorithm = SDNAAlgorithm(sdna_algorithm_spec, self.sdna_path, self.run_sdna_command)
+            self.addAlgorithm(sdna_algorithm)
+            if any(datatype in ["OFC", "OutFile"] for _, _, datatype, _, _, _ in sdna_algorithm_spec.getInputSpec()):
+                self.addAlgorithm(SDNASweepAlgorithm(sdna_algorithm_spec, self.sdna_path, self.run_sdna_command))
+        QgsMessageLog.logMessage(
+            f"Registered {len(sdna_algorithm_specs)} sDNA tools ({cache_status}) "
+            f"in {(time.perf_counter() - started) * 1000:.0f} ms",
+            "sDNA"
+        )
 
     def id(self):
         """The unique provider id. Should not be localised."""
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+
+from qgis.core import QgsMessageLog
+from processing.core.ProcessingConfig import ProcessingConfig
+
+from .sdna_plugin_cache import folder_size
+
+MB = 1024 * 1024
+
+# Rough sizes used to guess whether a shapefile will fit before it is written: a line feature
+# with a few dozen vertices, a numeric attribute, and the number of fields sDNA typically adds
+SHAPEFILE_BYTES_PER_FEATURE = 600
+SHAPEFILE_BYTES_PER_FIELD = 24
+SDNA_OUTPUT_FIELDS = 40
+
+
+def estimate_shapefile_size(feature_count, field_count):
+    """Guess the size in bytes of a shapefile of feature_count lines with field_count fields."""
+    return (feature_count or 0) * (SHAPEFILE_BYTES_PER_FEATURE + SHAPEFILE_BYTES_PER_FIELD * field_count)
+
+
+class ScratchSpace:
+    """Where a run puts intermediate files that nobody needs once it has finished.
+
+    If a scratch folder is set in the provider settings, usually on a RAM disk such as tmpfs,
+    files go there as long as their estimated size fits within its size limit and free space.
+    Everything else goes in the system temporary folder. cleanup deletes all of a run's files.
+
+    Temporary outputs are loaded by QGIS after the run, so those placed in the scratch folder
+    are kept in a folder for the session which is deleted when the plugin unloads.
+    """
+
+    FOLDER_SETTING = "SDNA_SCRATCH_FOLDER_SETTING"
+    MAX_SIZE_SETTING = "SDNA_SCRATCH_MAX_SIZE_SETTING"
+
+    def __init__(self, folder=None, max_size_mb=0):
+        self.folder = folder
+        self.max_size = max_size_mb * MB
+        self.reserved = 0
+        # The run's own folders, keyed by whether they are in the scratch folder
+        self.run_folders = {}
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_settings():
+        """Return the scratch space configured in the provider settings, which may be disk only."""
+        folder = ProcessingConfig.getSetting(ScratchSpace.FOLDER_SETTING)
+        max_size_mb = int(ProcessingConfig.getSetting(ScratchSpace.MAX_SIZE_SETTING) or 0)
+        if not folder or max_size_mb <= 0:
+            return ScratchSpace()
+        return ScratchSpace(folder, max_size_mb)
+
+    @staticmethod
+    def session_folder(folder):
+        return os.path.join(folder, f"sdna_outputs_{os.getpid()}")
+
+    def reserve(self, size):
+        """Set aside size bytes of the scratch folder, returning False if they do not fit."""
+        if not self.folder:
+            return False
+        with self.lock:
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                free = shutil.disk_usage(self.folder).free
+            except OSError:
+                return False
+            # Files of other runs are counted as they are; ours by the sizes reserved for them
+            own_folder = self.run_folders.get(True)
+            used = folder_size(self.folder) - (folder_size(own_folder) if own_folder else 0) + self.reserved
+            if used + size > self.max_size or size > free:
+                return False
+            self.reserved += size
+            return True
+
+    def run_folder(self, in_scratch):
+        with self.lock:
+            if in_scratch not in self.run_folders:
+                self.run_folders[in_scratch] = tempfile.mkdtemp(
+                    prefix="sdna_run_", dir=self.folder if in_scratch else None
+                )
+            return self.run_folders[in_scratch]
+
+    def unique_name(self, filename):
+        root, extension = os.path.splitext(filename)
+        return f"{root}_{next(self.counter)}{extension}"
+
+    def path(self, filename, estimated_size, allow_scratch=True):
+        """Return a path for a file of about estimated_size bytes that is deleted by cleanup."""
+        in_scratch = allow_scratch and self.reserve(estimated_size)
+        return os.path.join(self.run_folder(in_scratch), self.unique_name(filename))
+
+    def folder_path(self, name, estimated_size):
+        """Return a new folder for files totalling about estimated_size bytes that is deleted by cleanup."""
+        folder = self.path(name, estimated_size)
+        os.makedirs(folder)
+        return folder
+
+    def in_scratch(self, path):
+        own_folder = self.run_folders.get(True)
+        return bool(own_folder) and os.path.abspath(path).startswith(os.path.abspath(own_folder) + os.sep)
+
+    def output_path(self, filename, estimated_size):
+        """Return a path in the scratch folder for a temporary output, or None if it does not fit."""
+        if not self.reserve(estimated_size):
+            return None
+        folder = ScratchSpace.session_folder(self.folder)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, self.unique_name(filename))
+
+    def cleanup(self):
+        """Delete every file the run put in scratch space."""
+        with self.lock:
+            folders, self.run_folders = list(self.run_folders.values()), {}
+            self.reserved = 0
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+            if os.path.exists(folder):
+                QgsMessageLog.logMessage(f"Could not delete scratch folder {folder}", "sDNA")
+
+    @staticmethod
+    def remove_session_outputs():
+        """Delete temporary outputs kept in the scratch folder during this session."""
+        folder = ProcessingConfig.getSetting(ScratchSpace.FOLDER_SETTING)
+        if folder:
+            shutil.rmtree(ScratchSpace.session_folder(folder), ignore_errors=True)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import json
+import os
+
+from qgis.core import (
+    QgsApplication,
+    QgsMessageLog
+)
+
+from .sdna_plugin_cache import sdna_install_fingerprint
+
+
+def sdna_tool_classes():
+    import sDNAUISpec
+    return sDNAUISpec.get_tools()
+
+
+class CachedAlgorithmSpec:
+    """Stands in for an sDNAUISpec tool using a description of it saved on an earlier startup.
+
+    The real tool is only created, importing sDNA, when the syntax of a run is needed.
+    """
+
+    def __init__(self, class_name, alias, category, desc, input_spec):
+        self.class_name = class_name
+        self.alias = alias
+        self.category = category
+        self.desc = desc
+        self.input_spec = [tuple(spec) for spec in input_spec]
+        self.algorithm_spec = None
+
+    @classmethod
+    def describe(cls, algorithm_spec):
+        """Return a JSON-compatible description of a real sDNAUISpec tool."""
+        return {
+            "class_name": type(algorithm_spec).__name__,
+            "alias": algorithm_spec.alias,
+            "category": algorithm_spec.category,
+            "desc": algorithm_spec.desc,
+            "input_spec": [list(spec) for spec in algorithm_spec.getInputSpec()]
+        }
+
+    def getInputSpec(self):
+        return self.input_spec
+
+    def getSyntax(self, args):
+        if self.algorithm_spec is None:
+            for tool_class in sdna_tool_classes():
+                if tool_class.__name__ == self.class_name:
+                    self.algorithm_spec = tool_class()
+                    break
+            else:
+                raise ImportError(f"sDNA no longer provides the tool {self.class_name}")
+        return self.algorithm_spec.getSyntax(args)
+
+
+class LazySDNACommand:
+    """Stands in for sDNA's runsdnacommand, importing it the first time it is called."""
+
+    def __init__(self):
+        self.run_sdna_command = None
+
+    def __call__(self, syntax, sdna_path, progress, pythonexe=None, pythonpath=None):
+        if self.run_sdna_command is None:
+            import runsdnacommand
+            self.run_sdna_command = runsdnacommand.runsdnacommand
+        return self.run_sdna_command(syntax, sdna_path, progress, pythonexe, pythonpath)
+
+
+class SpecCache:
+    """Saves the descriptions of sDNA's tools to disk, keyed on the sDNA installation."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(QgsApplication.qgisSettingsDirPath(), "sdna", "spec_cache.json")
+
+    @staticmethod
+    def key(sdna_root_dir, sdna_path):
+        return f"{os.path.normcase(os.path.abspath(sdna_root_dir))}|{sdna_install_fingerprint(sdna_path)}"
+
+    def load(self, sdna_root_dir, sdna_path):
+        """Return the cached tools for this installation, or None if they have not been cached."""
+        try:
+            with open(self.path, encoding="utf-8") as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        descriptions = cache.get(self.key(sdna_root_dir, sdna_path))
+        if descriptions is None:
+            return None
+        return [CachedAlgorithmSpec(**description) for description in descriptions]
+
+    def save(self, sdna_root_dir, sdna_path, algorithm_specs):
+        try:
+            descriptions = [CachedAlgorithmSpec.describe(algorithm_spec) for algorithm_spec in algorithm_specs]
+            # Only the current installation is kept; other keys belong to old or moved installs
+            contents = json.dumps({self.key(sdna_root_dir, sdna_path): descriptions})
+        except (AttributeError, TypeError, ValueError) as e:
+            QgsMessageLog.logMessage(f"Could not cache sDNA tool descriptions: {e}", "sDNA")
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as cache_file:
+            cache_file.write(contents)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import os
+
+from qgis.core import (
+    QgsMessageLog,
+    QgsProcessingException,
+    QgsProcessingOutputMultipleLayers,
+    QgsProcessingParameterString
+)
+
+from .sdna_plugin_algorithm import SDNAAlgorithm
+from .sdna_plugin_formats import OUTPUT_FORMATS
+from .sdna_plugin_instrumentation import RunRecorder
+from .sdna_plugin_process import ResourceLimits
+from .sdna_plugin_scratch import ScratchSpace
+
+
+class SDNASweepAlgorithm(SDNAAlgorithm):
+    """Runs one sDNA tool several times over the same input with different parameters.
+
+    The input is converted once and the runs are shared out between a bounded number of
+    concurrent sDNA processes.
+    """
+
+    VARIANTS = "VARIANTS"
+    OUTPUTS = "OUTPUTS"
+    # The plugin parameters a sweep honours; the rest only apply to single runs
+    PLUGIN_PARAMETERS = [
+        SDNAAlgorithm.EXTENT,
+        SDNAAlgorithm.PRUNE_FIELDS,
+        SDNAAlgorithm.MAX_PROCESSES,
+        SDNAAlgorithm.OUTPUT_FORMAT
+    ]
+
+    def initAlgorithm(self, config):
+        SDNAAlgorithm.initAlgorithm(self, config)
+        self.addParameter(
+            QgsProcessingParameterString(
+                SDNASweepAlgorithm.VARIANTS,
+                self.tr("Parameter variants (one run per line, e.g. radii=400,800;metric=EUCLIDEAN)"),
+                multiLine=True
+            )
+        )
+        self.addOutput(QgsProcessingOutputMultipleLayers(SDNASweepAlgorithm.OUTPUTS, self.tr("Outputs of each run")))
+
+    def supports_plugin_parameter(self, name):
+        return name in SDNASweepAlgorithm.PLUGIN_PARAMETERS
+
+    def processAlgorithm(self, parameters, context, feedback):
+        self.recorder = RunRecorder(self.name())
+        self.scratch = ScratchSpace.from_settings()
+        self.limits = ResourceLimits.from_settings()
+        self.failed_runs = []
+        retval = None
+        try:
+            results, retval = self.process_variants(parameters, context, feedback)
+        finally:
+            self.scratch.cleanup()
+            self.recorder.finish(retval)
+        if self.limits.exceeded:
+            raise QgsProcessingException(f"sDNA was stopped because the sweep {self.limits.exceeded}")
+        if feedback.isCanceled():
+            raise QgsProcessingException("The sweep was cancelled")
+        if retval != 0:
+            raise QgsProcessingException(
+                f"Runs {', '.join(str(index + 1) for index in self.failed_runs)} of the sweep did not complete successfully; "
+                f"outputs of the other runs were kept"
+            )
+        return results
+
+    def process_variants(self, parameters, context, feedback):
+        """Run every variant, returning the algorithm's results and 0 if every run succeeded."""
+        source = self.parameterAsSource(parameters, 'input', context)
+        source_crs = source.sourceCrs()
+
+        with self.recorder.phase("extract arguments"):
+            args = self.extract_args(parameters, context)
+            variants = self.parse_variants(self.parameterAsString(parameters, SDNASweepAlgorithm.VARIANTS, context))
+            export_options = self.extract_export_options(parameters, context, args, source_crs)
+        max_processes = self.parameterAsInt(parameters, SDNAAlgorithm.MAX_PROCESSES, context) or 1
+        self.recorder.add(input_feature_counts={"input": source.featureCount()}, args=args, variants=variants)
+
+        # Converting the base run's inputs once gives every variant the same converted files
+        converted_inputs = self.extract_syntax(args, context, feedback, source_crs, export_options)["inputs"]
+
+        syntaxes = []
+        for index, overrides in enumerate(variants):
+            variant_args = dict(args)
+            variant_args.update(overrides)
+            for outname in self.outputnames:
+                # The first run writes to the requested outputs so QGIS loads them as usual
+                if args[outname] and index > 0:
+                    root, extension = os.path.splitext(args[outname])
+                    variant_args[outname] = f"{root}_{index + 1}{extension}"
+            syntax = self.algorithm_spec.getSyntax(variant_args)
+            syntax["inputs"] = converted_inputs
+            self.check_outputs(syntax, feedback)
+            syntaxes.append(syntax)
+
+        feedback.setProgressText(f"Running {len(syntaxes)} variants with up to {max_processes} concurrent sDNA processes")
+        with self.recorder.phase("sDNA", self.sdna_processes(syntaxes)):
+            retvals = self.run_concurrently(syntaxes, max_processes, feedback)
+        self.recorder.add(retvals=retvals)
+
+        _, driver_name, extension = OUTPUT_FORMATS[self.parameterAsEnum(parameters, SDNAAlgorithm.OUTPUT_FORMAT, context)]
+        outputs = []
+        self.failed_runs = [index for index, retval in enumerate(retvals) if retval != 0]
+        for index, (syntax, retval) in enumerate(zip(syntaxes, retvals)):
+            if retval != 0:
+                QgsMessageLog.logMessage(f"ERROR: RUN {index + 1} OF SWEEP DID NOT COMPLETE SUCCESSFULLY", "SDNA")
+                continue
+            for path in syntax["outputs"].values():
+                if path and extension != "shp" and path.lower().endswith(".shp"):
+                    with self.recorder.phase(f"convert run {index + 1} to {extension}"):
+                        path = self.transcode_output(path, driver_name, extension, context, feedback)
+                if path:
+                    outputs.append(path)
+        return {SDNASweepAlgorithm.OUTPUTS: outputs}, (1 if self.failed_runs else 0)
+
+    def parse_variants(self, text):
+        """Turn one 'name=value;name=value' line per run into a list of argument overrides."""
+        variants = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            overrides = {}
+            for assignment in line.split(";"):
+                if not assignment.strip():
+                    continue
+                name, separator, value = assignment.partition("=")
+                name, value = name.strip(), value.strip()
+                if not separator or name not in self.varnames or name in self.layervarnames:
+                    raise QgsProcessingException(f"Cannot vary '{name}' in a sweep of {self.name()}")
+                if name in self.selectvaroptions and value not in self.selectvaroptions[name]:
+                    raise QgsProcessingException(
+                        f"'{value}' is not one of {', '.join(self.selectvaroptions[name])} for '{name}'"
+                    )
+                overrides[name] = value
+            variants.append(overrides)
+        if not variants:
+            raise QgsProcessingException("No parameter variants given")
+        return variants
+
+    def name(self):
+        """The name of this algorithm. Should not be localised."""
+        return f"{self.algorithm_spec.alias}_sweep"
+
+    def displayName(self):
+        """The name of the algorithm in the UI. Should be localised."""
+        return self.tr(f"{self.algorithm_spec.alias} (parameter sweep)")
+
+    def group(self):
+        """The name of the algorithm's disclosure group in the UI. Should be localised."""
+        return self.tr("Parameter sweeps")
+
+    def groupId(self):
+        """The group ID of this algorithm. Should not be localised."""
+        return "sweeps"
+
+    def shortHelpString(self):
+        return (
+            f"{self.algorithm_spec.desc}\n\n"
+            "Runs the tool once for each line of parameter variants. Each line overrides "
+            "parameters of the dialog using name=value pairs separated by semicolons. The "
+            "input is converted once and runs share out the concurrent sDNA processes."
+        )
+
+    def createInstance(self):
+        return SDNASweepAlgorithm(self.algorithm_spec, self.sdna_path, self.run_sdna_command)
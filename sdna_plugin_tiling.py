@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (
+    QgsAggregateCalculator,
+    QgsCoordinateTransform,
+    QgsCoordinateTransformContext,
+    QgsFeatureRequest,
+    QgsField,
+    QgsGeometry,
+    QgsRectangle,
+    QgsVectorFileWriter,
+    QgsVectorLayer
+)
+
+WRITE_CHUNK_SIZE = 10000
+# Output field set to 1 for links inside the area of interest and 0 for those only there as context
+AREA_OF_INTEREST_FIELD = "sdna_inaoi"
+
+
+def max_radius(radii):
+    """Return the largest of sDNA's comma separated radii, or None if any radius is global ('n')."""
+    values = []
+    for radius in str(radii).split(","):
+        radius = radius.strip()
+        if not radius:
+            continue
+        if radius.lower() == "n":
+            return None
+        try:
+            values.append(float(radius))
+        except ValueError:
+            return None
+    return max(values) if values else None
+
+
+def max_link_length(layer):
+    length, ok = layer.aggregate(QgsAggregateCalculator.Max, "length($geometry)")
+    return float(length) if ok and length is not None else 0.0
+
+
+def representative_point(geometry):
+    """Return the point deciding which tile owns a link: its midpoint along the line."""
+    point = geometry.interpolate(geometry.length() / 2)
+    if point.isEmpty():
+        point = geometry.centroid()
+    return point.asPoint()
+
+
+class TileGrid:
+    """Divides an extent into a grid of core tiles, each buffered by a margin of context.
+
+    Every link belongs to exactly one core tile, the one containing its midpoint. The
+    margin must be large enough that everything which can affect a core link's results
+    lies within the buffered tile.
+    """
+
+    def __init__(self, extent, tiles_per_side, margin):
+        self.extent = extent
+        self.tiles_per_side = max(1, tiles_per_side)
+        self.margin = margin
+        self.tile_width = extent.width() / self.tiles_per_side
+        self.tile_height = extent.height() / self.tiles_per_side
+
+    def tiles(self):
+        return [(column, row) for row in range(self.tiles_per_side) for column in range(self.tiles_per_side)]
+
+    def core_extent(self, tile):
+        column, row = tile
+        x_minimum = self.extent.xMinimum() + column * self.tile_width
+        y_minimum = self.extent.yMinimum() + row * self.tile_height
+        return QgsRectangle(x_minimum, y_minimum, x_minimum + self.tile_width, y_minimum + self.tile_height)
+
+    def buffered_extent(self, tile):
+        return self.core_extent(tile).buffered(self.margin)
+
+    def tile_of(self, point):
+        def index(offset, size):
+            if size <= 0:
+                return 0
+            return min(max(int(offset / size), 0), self.tiles_per_side - 1)
+        return (
+            index(point.x() - self.extent.xMinimum(), self.tile_width),
+            index(point.y() - self.extent.yMinimum(), self.tile_height)
+        )
+
+    def has_features(self, layer, tile, feature_ids=None):
+        """Whether any feature of layer, or any of feature_ids if given, lies in the core of tile."""
+        request = QgsFeatureRequest().setFilterRect(self.core_extent(tile)).setNoAttributes()
+        if feature_ids is None:
+            return any(True for _ in layer.getFeatures(request.setLimit(1)))
+        return any(feature.id() in feature_ids for feature in layer.getFeatures(request))
+
+
+def stitch_outputs(tile_outputs, grid, destination, crs, feedback):
+    """Write the core links of each tile's output shapefile into one output shapefile.
+
+    tile_outputs maps each tile to the output sDNA wrote for it. Returns False if the
+    combined output could not be written.
+    """
+    writer = None
+    written = 0
+    for tile, path in tile_outputs.items():
+        layer = QgsVectorLayer(path, "tile", "ogr")
+        if not layer.isValid():
+            feedback.reportError(f"Could not open tile output {path}")
+            return False
+        if writer is None:
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = "ESRI Shapefile"
+            options.fileEncoding = "utf-8"
+            writer = QgsVectorFileWriter.create(
+                destination, layer.fields(), layer.wkbType(), crs, QgsCoordinateTransformContext(), options
+            )
+            if writer.hasError() != QgsVectorFileWriter.NoError:
+                feedback.reportError(f"Could not create {destination}: {writer.errorMessage()}")
+                return False
+        chunk = []
+        for feature in layer.getFeatures():
+            if not feature.hasGeometry() or grid.tile_of(representative_point(feature.geometry())) != tile:
+                continue
+            chunk.append(feature)
+            if len(chunk) >= WRITE_CHUNK_SIZE:
+                writer.addFeatures(chunk)
+                written += len(chunk)
+                chunk = []
+        writer.addFeatures(chunk)
+        written += len(chunk)
+    # Deleting the writer flushes and closes the file
+    del writer
+    feedback.setProgressText(f"Stitched {written} links from {len(tile_outputs)} tiles into {destination}")
+    return True
+
+
+def area_geometry(source, crs, transform_context):
+    """Return the union of the features of source as a single geometry in crs."""
+    transform = QgsCoordinateTransform(source.sourceCrs(), crs, transform_context)
+    geometries = []
+    for feature in source.getFeatures(QgsFeatureRequest().setNoAttributes()):
+        if feature.hasGeometry():
+            geometry = feature.geometry()
+            geometry.transform(transform)
+            geometries.append(geometry)
+    return QgsGeometry.unaryUnion(geometries)
+
+
+def features_near_area(layer, area, margin):
+    """Return the ids of the features of layer within margin of area.
+
+    Candidates come from a bounding box request, which the data provider answers from its
+    own spatial index, and are then tested exactly against the buffered area.
+    """
+    buffered = area.buffer(margin, 8)
+    engine = QgsGeometry.createGeometryEngine(buffered.constGet())
+    engine.prepareGeometry()
+    request = QgsFeatureRequest().setFilterRect(buffered.boundingBox()).setNoAttributes()
+    return [
+        feature.id() for feature in layer.getFeatures(request)
+        if feature.hasGeometry() and engine.intersects(feature.geometry().constGet())
+    ]
+
+
+def midpoint_in_area(engine, geometry):
+    """Whether the midpoint of a link lies in the area prepared in engine, which decides if the link is in the area."""
+    return engine.contains(QgsGeometry.fromPointXY(representative_point(geometry)).constGet())
+
+
+def features_in_area(layer, area, feature_ids):
+    """Return the ids among feature_ids of the features of layer whose midpoints lie in area.
+
+    These are the input links whose output mark_links_in_area marks as inside the area.
+    """
+    engine = QgsGeometry.createGeometryEngine(area.constGet())
+    engine.prepareGeometry()
+    request = QgsFeatureRequest().setFilterFids(sorted(feature_ids)).setNoAttributes()
+    return [
+        feature.id() for feature in layer.getFeatures(request)
+        if feature.hasGeometry() and midpoint_in_area(engine, feature.geometry())
+    ]
+
+
+def mark_links_in_area(path, area, feedback):
+    """Set AREA_OF_INTEREST_FIELD in the output shapefile at path for the links whose midpoints lie in area.
+
+    Returns the number of links inside the area.
+    """
+    layer = QgsVectorLayer(path, "output", "ogr")
+    if not layer.isValid():
+        feedback.reportError(f"Could not open {path} to mark the area of interest")
+        return 0
+    provider = layer.dataProvider()
+    if layer.fields().lookupField(AREA_OF_INTEREST_FIELD) < 0:
+        provider.addAttributes([QgsField(AREA_OF_INTEREST_FIELD, QVariant.Int)])
+        layer.updateFields()
+    index = layer.fields().lookupField(AREA_OF_INTEREST_FIELD)
+    engine = QgsGeometry.createGeometryEngine(area.constGet())
+    engine.prepareGeometry()
+    # Read every flag before writing any, so the file is not changed under the iterator
+    flags = []
+    for feature in layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+        inside = feature.hasGeometry() and midpoint_in_area(engine, feature.geometry())
+        flags.append((feature.id(), int(inside)))
+    for start in range(0, len(flags), WRITE_CHUNK_SIZE):
+        provider.changeAttributeValues({fid: {index: inside} for fid, inside in flags[start:start + WRITE_CHUNK_SIZE]})
+    return sum(inside for _, inside in flags)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import itertools
+import json
+import os
+import queue
+import re
+import subprocess
+import tempfile
+import threading
+import time
+
+from qgis.core import QgsMessageLog
+from processing.core.ProcessingConfig import ProcessingConfig
+
+from .sdna_plugin_process import terminate_process_tree
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sdna_worker.py")
+PROGRESS_PATTERN = re.compile(r"^\s*Progress:\s*([0-9.]+)\s*%")
+
+
+def split_command_line(text):
+    """Split text into arguments the way a Windows command line is, on spaces outside double quotes."""
+    arguments = []
+    current = None
+    quoted = False
+    for character in text:
+        if character == '"':
+            quoted = not quoted
+            current = current or ""
+        elif character.isspace() and not quoted:
+            if current is not None:
+                arguments.append(current)
+                current = None
+        else:
+            current = (current or "") + character
+    if current is not None:
+        arguments.append(current)
+    return arguments
+
+
+def map_to_argument(paths):
+    """Format a map of names to paths the way runsdnacommand passes --im and --om."""
+    return ";".join(name + "=" + path.rstrip("\\") for name, path in paths.items() if path)
+
+
+class SDNAWorker:
+    """A long-lived process that runs sDNA commands without starting a new interpreter each time.
+
+    The worker keeps sDNA's modules and libraries loaded between jobs. It is started on first
+    use, checked with a ping before a job if it has been idle, and restarted if it has died or
+    stops answering. Only one job runs at a time; callers that find it busy should start sDNA
+    the usual way instead.
+    """
+
+    ENABLED_SETTING = "SDNA_WORKER_ENABLED_SETTING"
+    PING_AFTER_IDLE = 60
+    PING_TIMEOUT = 10
+
+    def __init__(self):
+        self.process = None
+        self.process_key = None
+        self.messages = queue.Queue()
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.last_used = 0.0
+        self.stderr_file = None
+
+    @staticmethod
+    def enabled():
+        return bool(ProcessingConfig.getSetting(SDNAWorker.ENABLED_SETTING))
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, sdna_path, pythonexe, pythonpath):
+        self.stop()
+        sdna_bin = sdna_path.strip('"')
+        environment = os.environ.copy()
+        if pythonpath:
+            environment["PYTHONPATH"] = pythonpath
+        self.stderr_file = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            [pythonexe, "-u", WORKER_SCRIPT, sdna_bin],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self.stderr_file,
+            env=environment,
+            universal_newlines=True,
+            bufsize=1,
+            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0)
+        )
+        self.process_key = (sdna_path, pythonexe, pythonpath)
+        self.messages = queue.Queue()
+        threading.Thread(target=self.read_messages, args=(self.process, self.messages), daemon=True).start()
+        QgsMessageLog.logMessage(f"Started sDNA worker process {self.process.pid}", "sDNA")
+
+    @staticmethod
+    def read_messages(process, messages):
+        for line in process.stdout:
+            try:
+                messages.put(json.loads(line))
+            except ValueError:
+                messages.put({"type": "output", "id": None, "text": line.rstrip()})
+        # None tells the reader of the queue that the process has gone
+        messages.put(None)
+
+    def send(self, **message):
+        self.process.stdin.write(json.dumps(message) + "\n")
+        self.process.stdin.flush()
+
+    def ping(self):
+        try:
+            self.send(type="ping")
+        except OSError:
+            return False
+        deadline = time.monotonic() + SDNAWorker.PING_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                message = self.messages.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if message is None:
+                return False
+            if message["type"] == "pong":
+                return True
+        return False
+
+    def ensure_running(self, sdna_path, pythonexe, pythonpath):
+        key = (sdna_path, pythonexe, pythonpath)
+        healthy = self.is_alive() and self.process_key == key
+        if healthy and time.monotonic() - self.last_used > SDNAWorker.PING_AFTER_IDLE:
+            healthy = self.ping()
+        if not healthy:
+            if self.process is not None:
+                QgsMessageLog.logMessage(f"Restarting sDNA worker: {self.stderr_tail()}", "sDNA")
+            self.start(sdna_path, pythonexe, pythonpath)
+
+    def stderr_tail(self):
+        if not self.stderr_file:
+            return ""
+        try:
+            self.stderr_file.seek(0)
+            return self.stderr_file.read()[-2000:].decode("utf-8", "replace")
+        except (OSError, ValueError):
+            return ""
+
+    def try_run(self, syntax, sdna_path, progress, feedback, pythonexe=None, pythonpath=None):
+        """Run syntax in the worker, returning sDNA's return value, or None if the worker is busy or unavailable."""
+        if not pythonexe or not os.path.isfile(pythonexe):
+            # Inside QGIS sys.executable is usually QGIS itself, so without the Python interpreter
+            # sDNA would be run with there is nothing to start the worker with
+            return None
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            self.ensure_running(sdna_path, pythonexe, pythonpath)
+            return self.run(syntax, sdna_path, progress, feedback)
+        finally:
+            self.last_used = time.monotonic()
+            self.lock.release()
+
+    def run(self, syntax, sdna_path, progress, feedback):
+        job_id = next(self.job_ids)
+        script = os.path.join(sdna_path.strip('"'), syntax["command"] + ".py")
+        argv = [
+            "--im", map_to_argument(syntax["inputs"]),
+            "--om", map_to_argument(syntax["outputs"])
+        ] + split_command_line(syntax["config"])
+        progress.setInfo(f"Running in sDNA worker {self.process.pid}: {script} {' '.join(argv)}")
+        self.send(type="run", id=job_id, script=script, argv=argv)
+        while True:
+            if feedback is not None and feedback.isCanceled():
+                # The job cannot be interrupted inside the worker, so the worker goes with it
+                terminate_process_tree(self.process.pid)
+                self.process = None
+                return 1
+            try:
+                message = self.messages.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if message is None:
+                progress.setInfo(f"ERROR: sDNA worker stopped unexpectedly\n{self.stderr_tail()}")
+                self.process = None
+                return 1
+            if message["type"] == "output" and message["id"] in [job_id, None]:
+                match = PROGRESS_PATTERN.match(message["text"])
+                if match:
+                    progress.setPercentage(float(match.group(1)))
+                else:
+                    progress.setInfo(message["text"])
+            elif message["type"] == "done" and message["id"] == job_id:
+                return message["retval"]
+
+    def stop(self):
+        if self.process is None:
+            return
+        process, self.process = self.process, None
+        try:
+            process.stdin.write(json.dumps({"type": "exit"}) + "\n")
+            process.stdin.flush()
+            process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            terminate_process_tree(process.pid)
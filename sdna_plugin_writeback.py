@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (
+    QgsFeatureRequest,
+    QgsField,
+    QgsProcessingException,
+    QgsProviderRegistry,
+    QgsTransaction,
+    QgsVectorLayer
+)
+
+# Output field holding the feature id of each input feature, short enough for a shapefile
+SOURCE_ID_FIELD = "sdna_srcid"
+# Layer custom property listing the result fields last written back onto a layer
+RESULT_FIELDS_PROPERTY = "sdna/result_fields"
+UPDATE_BATCH_SIZE = 10000
+SHAPEFILE_FIELD_NAME_LENGTH = 10
+
+
+def is_null(value):
+    return value is None or (isinstance(value, QVariant) and value.isNull())
+
+
+def result_fields(output_fields, exported_field_names, key_field):
+    """Return the fields sDNA added to its output, leaving out those copied from the exported input.
+
+    Earlier results written back onto the input must be left out of the export, or their
+    new values would be taken for copies of the input and never written.
+    """
+    copied = {name.lower()[:SHAPEFILE_FIELD_NAME_LENGTH] for name in exported_field_names}
+    copied.add(key_field.lower()[:SHAPEFILE_FIELD_NAME_LENGTH])
+    copied.add(SOURCE_ID_FIELD)
+    return [field for field in output_fields if field.name().lower() not in copied]
+
+
+def output_key_field(output, key_field):
+    """Return the name key_field has in the output, where a shapefile may have truncated it."""
+    fields = output.fields()
+    for name in [key_field, key_field[:SHAPEFILE_FIELD_NAME_LENGTH]]:
+        index = fields.lookupField(name)
+        if index >= 0:
+            return fields.at(index).name()
+    raise QgsProcessingException(f"sDNA output has no field {key_field} to match results on")
+
+
+def read_columns(layer, field_names):
+    """Read the named fields of every feature of layer, without geometry, as one list per field."""
+    fields = layer.fields()
+    indexes = [fields.lookupField(name) for name in field_names]
+    missing = [name for name, index in zip(field_names, indexes) if index < 0]
+    if missing:
+        raise QgsProcessingException(f"{layer.name()} has no field {', '.join(missing)}")
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(indexes)
+    columns = [[] for _ in indexes]
+    for feature in layer.getFeatures(request):
+        attributes = feature.attributes()
+        for column, index in zip(columns, indexes):
+            column.append(attributes[index])
+    return columns
+
+
+def feature_ids_by_key(layer, key_field):
+    """Map each value of key_field in layer to the id of the feature having it."""
+    index = layer.fields().lookupField(key_field)
+    if index < 0:
+        raise QgsProcessingException(f"{layer.name()} has no field {key_field} to match results on")
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([index])
+    return {feature.attributes()[index]: feature.id() for feature in layer.getFeatures(request)}
+
+
+def open_for_writing(layer):
+    """Return a layer on the same data as layer that this thread can write to.
+
+    Memory layers cannot be reopened from their source, so are written to directly.
+    """
+    if layer.providerType() == "memory":
+        return layer
+    writable = QgsVectorLayer(layer.source(), layer.name(), layer.providerType())
+    if not writable.isValid():
+        raise QgsProcessingException(f"Could not open {layer.name()} to write results to")
+    return writable
+
+
+def same_data(layer, other):
+    """Whether two layers read the same data, so that feature ids of one identify features of the other."""
+    if layer.id() == other.id():
+        return True
+    if layer.providerType() != other.providerType():
+        return False
+    registry = QgsProviderRegistry.instance()
+    parts = [registry.decodeUri(candidate.providerType(), candidate.source()) for candidate in [layer, other]]
+    if not parts[0]:
+        return layer.source() == other.source()
+    # Filters change which features a layer shows, not their ids
+    for part in parts:
+        part.pop("subset", None)
+        part.pop("sql", None)
+    return parts[0] == parts[1]
+
+
+def write_back(output_path, target, key_field, exported_field_names, feedback, flag_field=None):
+    """Copy the fields sDNA added to the output at output_path onto the matching features of target.
+
+    key_field is the output field matching output features to those of target: SOURCE_ID_FIELD
+    holds the feature ids of target itself, and any other field is matched against the target
+    field of the same name. exported_field_names are the fields of the input sDNA was given,
+    which it copies to its output. If flag_field is given, only output features with it set to
+    1 are written, and the field itself is not. Fields that target lacks are added to it.
+    Values are written in batches, all in one transaction where the target's provider supports
+    transactions. Returns the number of features updated and the names of the fields written.
+    """
+    output = QgsVectorLayer(output_path, "sdna_output", "ogr")
+    if not output.isValid():
+        raise QgsProcessingException(f"Could not open sDNA output {output_path}")
+    fields = result_fields(output.fields(), exported_field_names, key_field)
+    if flag_field is not None:
+        fields = [field for field in fields if field.name().lower() != flag_field.lower()]
+    if not fields:
+        feedback.setProgressText("No result fields to write back")
+        return 0, []
+
+    feedback.setProgressText(f"Reading {len(fields)} result fields from {output_path}")
+    columns = read_columns(output, [output_key_field(output, key_field)] + [field.name() for field in fields] + ([flag_field] if flag_field else []))
+    if flag_field is not None:
+        flags = columns.pop()
+        columns = [[value for value, flag in zip(column, flags) if flag == 1] for column in columns]
+        feedback.setProgressText(f"Writing back the {len(columns[0])} output features with {flag_field} set")
+    key_column, *value_columns = columns
+    if key_field == SOURCE_ID_FIELD:
+        feature_ids = [None if is_null(key) else int(key) for key in key_column]
+    else:
+        feature_id_of_key = feature_ids_by_key(target, key_field)
+        feature_ids = [feature_id_of_key.get(key) for key in key_column]
+    unmatched = feature_ids.count(None)
+    if unmatched:
+        feedback.setProgressText(f"WARNING: {unmatched} output features match nothing in {target.name()}")
+
+    transaction = QgsTransaction.create({target}) if QgsTransaction.supportsTransaction({target}) else None
+    if transaction is not None:
+        began, error = transaction.begin()
+        if not began:
+            raise QgsProcessingException(f"Could not start a transaction on {target.name()}: {error}")
+    try:
+        provider = target.dataProvider()
+        missing = [QgsField(field) for field in fields if target.fields().lookupField(field.name()) < 0]
+        if missing:
+            if not provider.addAttributes(missing):
+                raise QgsProcessingException(f"Could not add result fields to {target.name()}")
+            target.updateFields()
+        indexes = [target.fields().lookupField(field.name()) for field in fields]
+
+        updated = 0
+        total = len(feature_ids)
+        for start in range(0, total, UPDATE_BATCH_SIZE):
+            if feedback.isCanceled():
+                raise QgsProcessingException("Writing results back was cancelled")
+            changes = {}
+            for row in range(start, min(start + UPDATE_BATCH_SIZE, total)):
+                if feature_ids[row] is not None:
+                    changes[feature_ids[row]] = {index: column[row] for index, column in zip(indexes, value_columns)}
+            if not provider.changeAttributeValues(changes):
+                raise QgsProcessingException(f"Could not write results to {target.name()}")
+            updated += len(changes)
+            feedback.setProgress(100 * min(start + UPDATE_BATCH_SIZE, total) / total)
+
+        if transaction is not None:
+            committed, error = transaction.commit()
+            if not committed:
+                raise QgsProcessingException(f"Could not commit results to {target.name()}: {error}")
+            transaction = None
+        return updated, [field.name() for field in fields]
+    finally:
+        if transaction is not None:
+            transaction.rollback()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Long-lived sDNA worker process, started by sdna_plugin_worker.SDNAWorker.
+
+ Runs with the Python interpreter used for sDNA and must not import QGIS. Jobs arrive as
+ JSON lines on stdin and each is run in this process by executing the sDNA command script
+ as __main__, so sDNA's modules and libraries stay loaded between jobs. Everything the
+ script prints is sent back as JSON lines on stdout.
+
+ Messages in:   {"type": "ping"}
+                {"type": "run", "id": ..., "script": ..., "argv": [...]}
+                {"type": "exit"}
+ Messages out:  {"type": "pong"}
+                {"type": "output", "id": ..., "text": ...}
+                {"type": "done", "id": ..., "retval": ...}
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import json
+import os
+import runpy
+import sys
+import threading
+import traceback
+
+
+class ProtocolChannel:
+    """Writes protocol messages to the real stdout, one JSON object per line."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def send(self, **message):
+        with self.lock:
+            self.stream.write(json.dumps(message) + "\n")
+            self.stream.flush()
+
+
+class OutputRedirector:
+    """Stands in for sys.stdout and sys.stderr while a job runs, forwarding whole lines."""
+
+    def __init__(self, channel, job_id):
+        self.channel = channel
+        self.job_id = job_id
+        self.buffer = ""
+
+    def write(self, text):
+        self.buffer += text
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            self.channel.send(type="output", id=self.job_id, text=line.rstrip("\r"))
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            self.channel.send(type="output", id=self.job_id, text=self.buffer)
+            self.buffer = ""
+
+
+def run_job(channel, job):
+    redirector = OutputRedirector(channel, job["id"])
+    saved_argv, saved_stdout, saved_stderr = sys.argv, sys.stdout, sys.stderr
+    sys.argv = [job["script"]] + job["argv"]
+    sys.stdout = sys.stderr = redirector
+    retval = 0
+    try:
+        runpy.run_path(job["script"], run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            retval = 0
+        elif isinstance(e.code, int):
+            retval = e.code
+        else:
+            redirector.write(f"{e.code}\n")
+            retval = 1
+    except BaseException:
+        redirector.write(traceback.format_exc())
+        retval = 1
+    finally:
+        redirector.flush()
+        sys.argv, sys.stdout, sys.stderr = saved_argv, saved_stdout, saved_stderr
+    channel.send(type="done", id=job["id"], retval=retval)
+
+
+def main():
+    channel = ProtocolChannel(sys.stdout)
+    sdna_bin = sys.argv[1] if len(sys.argv) > 1 else None
+    if sdna_bin and sdna_bin not in sys.path:
+        # sDNA's scripts import their sibling modules
+        sys.path.insert(0, sdna_bin)
+        os.environ["PATH"] = os.environ.get("PATH", "") + os.pathsep + sdna_bin
+    for line in sys.stdin:
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if message["type"] == "ping":
+            channel.send(type="pong")
+        elif message["type"] == "run":
+            run_job(channel, message)
+        elif message["type"] == "exit":
+            break
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Tests of the conversion of sDNA table outputs to binary matrices, which need no QGIS.
+"""
+
+__author__ = "Crispin Cooper, Jeffrey Morgan"
+__date__ = "July 2020"
+__copyright__ = "(C) 2020 Cardiff University"
+
+# This will get replaced with a git SHA1 when you do a git archive
+
+__revision__ = "$Format:%H$"
+
+import json
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sdna_plugin_matrix import (
+    MatrixReader,
+    convert_csv_to_matrix,
+    matrix_paths
+)
+
+
+class Feedback:
+    """Records the progress a conversion reports, and cancels it if asked to."""
+
+    def __init__(self, canceled=False):
+        self.canceled = canceled
+        self.progress = []
+
+    def isCanceled(self):
+        return self.canceled
+
+    def setProgress(self, progress):
+        self.progress.append(progress)
+
+
+def write_csv(folder, text, name="table.csv"):
+    path = os.path.join(str(folder), name)
+    with open(path, "w", encoding="utf-8", newline="") as csv_file:
+        csv_file.write(text)
+    return path
+
+
+def test_wide_csv(tmp_path):
+    path = write_csv(tmp_path, "origin,a,b,c\nx,1,2,3\ny,4,5,6\n")
+    feedback = Feedback()
+    index_path = convert_csv_to_matrix(path, feedback)
+    assert index_path == matrix_paths(path)[0]
+    assert feedback.progress[-1] == 100
+    with open(index_path, encoding="utf-8") as index_file:
+        index = json.load(index_file)
+    assert index["shape"] == [2, 3, 1]
+    assert index["origins"] == ["x", "y"]
+    assert index["destinations"] == ["a", "b", "c"]
+    with MatrixReader(index_path) as reader:
+        assert reader.row("x") == [1.0, 2.0, 3.0]
+        assert reader.row("y") == [4.0, 5.0, 6.0]
+        assert reader.get("y", "b") == 5.0
+
+
+def test_wide_csv_pads_short_rows_with_nan(tmp_path):
+    path = write_csv(tmp_path, "origin,a,b,c\nx,1\ny,4,not a number,6\n")
+    with MatrixReader(convert_csv_to_matrix(path, Feedback())) as reader:
+        x_row = reader.row("x")
+        assert x_row[0] == 1.0
+        assert math.isnan(x_row[1]) and math.isnan(x_row[2])
+        assert math.isnan(reader.get("y", "b"))
+        assert reader.get("y", "c") == 6.0
+
+
+def test_long_csv(tmp_path):
+    # Rows in any order, with two values for each pair and one pair missing
+    path = write_csv(tmp_path, "origin,destination,dist,time\nb,q,4,40\na,p,1,10\na,q,2,20\n")
+    index_path = convert_csv_to_matrix(path, Feedback())
+    with open(index_path, encoding="utf-8") as index_file:
+        index = json.load(index_file)
+    assert index["shape"] == [2, 2, 2]
+    assert index["values"] == ["dist", "time"]
+    with MatrixReader(index_path) as reader:
+        assert reader.get("a", "p", "dist") == 1.0
+        assert reader.get("a", "q", "time") == 20.0
+        # Destinations keep the order they first appear in
+        assert index["destinations"] == ["q", "p"]
+        assert reader.row("a", "time") == [20.0, 10.0]
+        assert reader.get("b", "q", 1) == 40.0
+        missing = reader.row("b", "dist")
+        assert missing[0] == 4.0 and math.isnan(missing[1])
+
+
+def test_empty_csv(tmp_path):
+    path = write_csv(tmp_path, "")
+    with pytest.raises(ValueError):
+        convert_csv_to_matrix(path, Feedback())
+    for matrix_path in matrix_paths(path):
+        assert not os.path.exists(matrix_path)
+
+
+def test_header_only_csv(tmp_path):
+    path = write_csv(tmp_path, "origin,destination,dist\n")
+    with MatrixReader(convert_csv_to_matrix(path, Feedback())) as reader:
+        assert reader.index["shape"] == [0, 0, 1]
+
+
+def test_cancelled_conversion_leaves_no_files(tmp_path):
+    path = write_csv(tmp_path, "origin,a\nx,1\n")
+    with pytest.raises(InterruptedError):
+        convert_csv_to_matrix(path, Feedback(canceled=True))
+    for matrix_path in matrix_paths(path):
+        assert not os.path.exists(matrix_path)